@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+""" Compares the class lookups of kommons.plugin.Module with the previous
+implementation scanning the module on each call
+
+Usage: python benchmarks/plugin.py [--classes N] [--lookups N]
+"""
+
+import argparse
+import inspect
+import os
+import sys
+import timeit
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from kommons.plugin import Module
+
+
+class ScanModule(Module):
+    """ The previous Module implementation scanning the module __dict__ """
+
+    def get_classes(self, parentclass=None, all=False):
+        classes = []
+        for key, value in self.module.__dict__.items():
+            if inspect.isclass(value):
+                if parentclass:
+                    if not issubclass(value, parentclass):
+                        continue
+                if not all and value.__module__ != self.module.__name__:
+                    continue
+                classes.append(value)
+        return classes
+
+    def get_class(self, classname):
+        for cls in self.get_classes():
+            if cls.__name__ == classname:
+                return cls
+        return None
+
+
+def create_module(classes):
+    lines = ["class Plugin(object):", "    pass", ""]
+    for i in range(classes):
+        lines.append("class Plugin%d(Plugin):" % i)
+        lines.append("    pass")
+        lines.append("")
+        lines.append("value%d = %d" % (i, i))
+    module = types.ModuleType("benchmark_plugins")
+    exec("\n".join(lines), module.__dict__)
+    return module
+
+
+def measure(cls, module, lookups):
+    module = cls(module)
+    names = [name for name in module.module.__dict__
+             if name.startswith("Plugin")]
+    parent = module.module.Plugin
+
+    def get_class():
+        for i in range(lookups):
+            module.get_class(names[i % len(names)])
+
+    def get_classes():
+        for i in range(lookups):
+            module.get_classes(parent)
+
+    return [timeit.timeit(func, number=1) for func in (get_class,
+                                                       get_classes)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--classes", type=int, default=200)
+    parser.add_argument("--lookups", type=int, default=10000)
+    args = parser.parse_args()
+
+    module = create_module(args.classes)
+
+    print("%-12s %12s %12s" % ("", "get_class", "get_classes"))
+    for name, cls in (("scan", ScanModule), ("index", Module)):
+        print("%-12s" % name + "".join(
+            " %10.2fms" % (t * 1000) for t in measure(cls, module,
+                                                        args.lookups)))
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: et sw=4 ts=4 tw=80:
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+""" Compares kommons.signals.Signal with the previous list based
+implementation
+
+Usage: python benchmarks/signals.py [--slots N] [--emits N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from kommons.signals import MethodRef, Signal
+
+
+class ListSignal(object):
+    """ The previous list based Signal implementation """
+
+    def __init__(self):
+        self.slots = []
+
+    def __call__(self, *args, **kwargs):
+        for i, slot in enumerate(self.slots):
+            if slot.dead():
+                del self.slots[i]
+                continue
+
+            slot(*args, **kwargs)
+
+    def connect(self, slot):
+        if not slot in self.slots:
+            self.slots.append(MethodRef(slot))
+
+    def disconnect(self, slot):
+        for i, cur_slot in enumerate(self.slots):
+            if cur_slot == slot:
+                del self.slots[i]
+                return
+
+
+class Receiver(object):
+
+    def slot(self, value):
+        pass
+
+
+def measure(cls, slots, emits):
+    receivers = [Receiver() for i in range(slots)]
+    signal = cls()
+
+    def connect():
+        for receiver in receivers:
+            signal.connect(receiver.slot)
+
+    def emit():
+        for i in range(emits):
+            signal(i)
+
+    def disconnect():
+        for receiver in receivers:
+            signal.disconnect(receiver.slot)
+
+    return [timeit.timeit(func, number=1) for func in (connect, emit,
+                                                       disconnect)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slots", type=int, default=2000)
+    parser.add_argument("--emits", type=int, default=200)
+    args = parser.parse_args()
+
+    print("%-12s %12s %12s %12s" % ("", "connect", "emit", "disconnect"))
+    for name, cls in (("list", ListSignal), ("dict", Signal)):
+        print("%-12s" % name + "".join(
+            " %10.2fms" % (t * 1000) for t in measure(cls, args.slots,
+                                                        args.emits)))
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: et sw=4 ts=4 tw=80:
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+""" Compares the latency of spawning processes with the different spawners
+depending on the memory of the calling process
+
+Usage: python benchmarks/spawn.py [--memory MB] [--count N]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from kommons.process import Process
+from kommons.spawn import PopenSpawner, PosixSpawner, SpawnServer
+
+
+def measure(spawner, count):
+    process = Process(["true"], spawner=spawner)
+    start = time.time()
+    for i in range(count):
+        process.run()
+    return (time.time() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--memory", type=int, nargs="+", default=[0, 1024],
+                        help="Memory of the caller in MB")
+    parser.add_argument("--count", type=int, default=200,
+                        help="Number of spawned processes per measurement")
+    args = parser.parse_args()
+
+    server = SpawnServer()
+    server.start()
+    try:
+        spawners = [("popen", PopenSpawner()), ("posix_spawn", PosixSpawner()),
+                    ("server", server)]
+        print("%10s %12s %12s %12s" % (("memory",) +
+                                       tuple(name for name, s in spawners)))
+        for memory in args.memory:
+            # touch every page to make it part of the RSS
+            ballast = bytearray(memory * 1024 * 1024)
+            for i in range(0, len(ballast), 4096):
+                ballast[i] = 1
+            results = [measure(spawner, args.count) for name, spawner in
+                       spawners]
+            print("%8dMB" % memory +
+                  "".join(" %10.3fms" % (r * 1000) for r in results))
+            del ballast
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: et sw=4 ts=4 tw=80:
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+""" asyncio support for kommons.process
+
+This module requires python >= 3.6. It's used by Process.arun and
+Process.astream and shouldn't be imported directly.
+"""
+
+import asyncio
+import os
+import signal
+import subprocess
+
+from kommons.process import (OutputTail, ProcessResult, SubprocessError,
+                              READ_SIZE, clock)
+
+
+def _kill(process, new_session):
+    try:
+        if new_session:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+async def _terminate(process, new_session):
+    _kill(process, new_session)
+    # reap the child. the wait is shielded to finish even if the awaiting
+    # task is cancelled again.
+    await asyncio.shield(process.wait())
+
+
+async def _start(cmd, extra_env=None, **kw):
+    # run the child in its own process group to be able to kill all of its
+    # children on cancellation
+    kw.setdefault("start_new_session", True)
+    if extra_env:
+        env = kw.get("env", os.environ).copy()
+        env.update(extra_env)
+        kw["env"] = env
+    try:
+        return await asyncio.create_subprocess_exec(*cmd, **kw)
+    except OSError as e:
+        raise SubprocessError(cmd, e.errno, e.strerror)
+
+
+async def _feed(stdin, inputdata):
+    if not isinstance(inputdata, bytes):
+        inputdata = inputdata.encode("utf-8")
+    try:
+        stdin.write(inputdata)
+        await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # child doesn't want to read more input
+        pass
+    finally:
+        stdin.close()
+
+
+async def _read(stream, name, chunks, lines):
+    rest = b""
+    while True:
+        data = await stream.read(READ_SIZE)
+        if not data:
+            break
+        if lines:
+            data = (rest + data).splitlines(True)
+            rest = data.pop() if not data[-1].endswith(b"\n") else b""
+        else:
+            data = [data]
+        for chunk in data:
+            await chunks.put((name, chunk))
+    if rest:
+        await chunks.put((name, rest))
+    await chunks.put((name, None))
+
+
+async def astream(process, inputdata=None, extra_env=None, lines=False,
+                  tail_size=None, **kw):
+    if inputdata is not None:
+        kw["stdin"] = subprocess.PIPE
+    kw.setdefault("stdout", subprocess.PIPE)
+    kw.setdefault("stderr", subprocess.PIPE)
+    if tail_size is None:
+        tail_size = process.tail_size
+    tail = OutputTail(tail_size)
+
+    new_session = kw.get("start_new_session", True)
+    proc = await _start(process.cmd, extra_env, **kw)
+    # bounded queue to stop reading if the consumer is slow
+    chunks = asyncio.Queue(16)
+    tasks = []
+    if proc.stdin:
+        tasks.append(asyncio.ensure_future(_feed(proc.stdin, inputdata)))
+    readers = 0
+    for name in ("stdout", "stderr"):
+        stream = getattr(proc, name)
+        if stream:
+            tasks.append(asyncio.ensure_future(_read(stream, name, chunks,
+                                                     lines)))
+            readers += 1
+
+    finished = False
+    try:
+        while readers:
+            name, data = await chunks.get()
+            if data is None:
+                readers -= 1
+                continue
+            tail.append(data)
+            yield name, data
+        # raise the errors of the tasks e.g. if the input couldn't be written
+        await asyncio.gather(*tasks)
+        ret = await proc.wait()
+        finished = True
+    finally:
+        if not finished:
+            # cancelled, closed by the consumer or an error occurred
+            for task in tasks:
+                task.cancel()
+            await _terminate(proc, new_session)
+    if ret != 0:
+        raise SubprocessError(process.cmd, ret, tail.get())
+
+
+async def arun(process, suppress_output=False, inputdata=None,
+               extra_env=None, capture_output=False, **kw):
+    start = clock()
+    if capture_output and not suppress_output:
+        counts = {"stdout": 0, "stderr": 0}
+        async for name, data in astream(process, inputdata, extra_env, **kw):
+            counts[name] += len(data)
+        return ProcessResult(process, 0, clock() - start, None,
+                             counts["stdout"], counts["stderr"])
+
+    if inputdata is not None:
+        kw["stdin"] = subprocess.PIPE
+    if suppress_output:
+        kw["stdout"] = subprocess.DEVNULL
+        kw["stderr"] = subprocess.DEVNULL
+    proc = await _start(process.cmd, extra_env, **kw)
+    finished = False
+    try:
+        if inputdata is not None:
+            await _feed(proc.stdin, inputdata)
+        ret = await proc.wait()
+        finished = True
+    finally:
+        if not finished:
+            # cancelled or an error occurred
+            await _terminate(proc, kw.get("start_new_session", True))
+    if ret != 0:
+        raise SubprocessError(process.cmd, ret)
+    return ProcessResult(process, ret, clock() - start)
+
+# vim: et sw=4 ts=4 tw=80:
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+""" asyncio support for kommons.signals
+
+This module requires python >= 3.5. It's used by Signal.emit_async and
+shouldn't be imported directly.
+"""
+
+import asyncio
+import functools
+
+
+async def _wait(awaitable, timeout):
+    if awaitable is None:
+        # the slot has died in the meantime
+        return
+    if timeout is None:
+        await awaitable
+    else:
+        await asyncio.wait_for(awaitable, timeout)
+
+
+async def _call(slot, args, kwargs, semaphore, timeout, offload):
+    func = slot.get_function()
+    if func is None:
+        return
+    if asyncio.iscoroutinefunction(func):
+        if semaphore is None:
+            await _wait(slot(*args, **kwargs), timeout)
+        else:
+            async with semaphore:
+                await _wait(slot(*args, **kwargs), timeout)
+    elif offload:
+        loop = asyncio.get_event_loop()
+        await _wait(loop.run_in_executor(
+            None, functools.partial(slot, *args, **kwargs)), timeout)
+    else:
+        slot(*args, **kwargs)
+
+
+async def emit_async(signal, args, kwargs):
+    semaphore = None
+    if signal.async_concurrency:
+        semaphore = asyncio.Semaphore(signal.async_concurrency)
+    results = await asyncio.gather(
+        *[_call(slot, args, kwargs, semaphore, signal.async_timeout,
+                signal.async_offload) for slot in signal.get_slots()],
+        return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+# vim: et sw=4 ts=4 tw=80:
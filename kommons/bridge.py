@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+""" Forwarding of signal emissions to other processes
+
+A SignalSender forwards the emissions of selected Signals over a connected
+Unix domain socket or a multiprocessing pipe. A SignalReceiver in the other
+process emits them again on local Signals with the same name e.g.
+
+    parent, child = socket.socketpair()
+    sender = SignalSender(parent)
+    sender.forward(job.finished, "job.finished")
+    ...
+    receiver = SignalReceiver(child)
+    receiver.get_signal("job.finished").connect(on_finished)
+    receiver.run()
+"""
+
+import pickle
+import struct
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from kommons.errors import KommonRuntimeError
+from kommons.signals import Signal
+
+HEADER = struct.Struct("!I")
+
+
+class SignalBridgeError(KommonRuntimeError):
+    pass
+
+
+def _send_frame(connection, data):
+    if hasattr(connection, "send_bytes"):
+        # multiprocessing connection. it does its own framing.
+        connection.send_bytes(data)
+    else:
+        connection.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_frame(connection):
+    """ Returns the data of the next frame or None if the connection has been
+    closed by the sender
+    """
+    try:
+        if hasattr(connection, "recv_bytes"):
+            return connection.recv_bytes()
+        size, = HEADER.unpack(_recv_exact(connection, HEADER.size))
+        return _recv_exact(connection, size)
+    except EOFError:
+        return None
+
+
+class Forward(object):
+
+    def __init__(self, sender, name):
+        self.sender = sender
+        self.name = name
+
+    def emit(self, *args, **kwargs):
+        self.sender.put(self.name, args, kwargs)
+
+
+class SignalSender(object):
+    """ Forwards emissions of Signals to another process
+
+    Emissions are pickled by the emitting thread and queued. A background
+    thread writes them. All emissions queued while a frame is written are
+    sent together in the next frame. The queue is bounded. If the receiver is
+    too slow the socket buffer and afterwards the queue fill up and emitting a
+    forwarded Signal blocks until the receiver catches up.
+    """
+
+    max_batch = 512
+
+    def __init__(self, connection, max_pending=1024, timeout=None):
+        """ Creates a new SignalSender instance
+
+        :param connection A connected socket or a multiprocessing Connection
+        :param max_pending Number of emissions that can be queued before
+                           emitting blocks
+        :param timeout If set a SignalBridgeError is raised if an emission
+                       could not be queued within timeout seconds
+        """
+        self.connection = connection
+        self.timeout = timeout
+        self.queue = queue.Queue(max_pending)
+        self.forwards = {}
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _get_batch(self):
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        while len(batch) < self.max_batch:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # send the batch and stop afterwards
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            if batch is None:
+                break
+            if self.error is not None:
+                # drop the emissions to not block the emitters
+                continue
+            try:
+                # the emissions are pickled already. the frame is a list of
+                # their data.
+                _send_frame(self.connection,
+                            pickle.dumps(batch, pickle.HIGHEST_PROTOCOL))
+            except Exception as e:
+                self.error = e
+
+    def put(self, name, args, kwargs):
+        """ Queues an emission of the Signal forwarded as name """
+        if self.closed:
+            raise SignalBridgeError("Sender is closed")
+        if self.error is not None:
+            raise SignalBridgeError("Could not send emissions. %s" %
+                                    self.error)
+        try:
+            data = pickle.dumps((name, args, kwargs), pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise SignalBridgeError("Could not pickle emission of %s. %s" %
+                                    (name, e))
+        try:
+            self.queue.put(data, True, self.timeout)
+        except queue.Full:
+            raise SignalBridgeError("Could not forward emission of %s. The "
+                                    "receiver is too slow." % name)
+
+    def forward(self, signal, name):
+        """ Forwards all emissions of signal as name
+
+        The arguments of the emissions must be picklable. Otherwise emitting
+        signal raises a SignalBridgeError.
+        """
+        forward = Forward(self, name)
+        signal.connect(forward.emit)
+        self.forwards[name] = (signal, forward)
+
+    def unforward(self, name):
+        signal, forward = self.forwards.pop(name)
+        signal.disconnect(forward.emit)
+
+    def close(self):
+        """ Sends all queued emissions and closes the connection """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        for name in list(self.forwards):
+            self.unforward(name)
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SignalReceiver(object):
+    """ Emits Signals received from a SignalSender in another process """
+
+    def __init__(self, connection):
+        """ Creates a new SignalReceiver instance
+
+        :param connection A connected socket or a multiprocessing Connection
+        """
+        self.connection = connection
+        self.signals = {}
+
+    def get_signal(self, name):
+        """ Returns the local Signal for emissions forwarded as name """
+        signal = self.signals.get(name)
+        if signal is None:
+            signal = Signal()
+            self.signals[name] = signal
+        return signal
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def receive(self):
+        """ Receives the next batch of emissions and emits them
+
+        Blocks until a batch is available. Emissions without a local Signal
+        are dropped. Returns the number of received emissions or None if the
+        sender has closed the connection.
+        """
+        data = _recv_frame(self.connection)
+        if data is None:
+            return None
+        batch = pickle.loads(data)
+        for data in batch:
+            name, args, kwargs = pickle.loads(data)
+            signal = self.signals.get(name)
+            if signal is not None:
+                signal(*args, **kwargs)
+        return len(batch)
+
+    def run(self):
+        """ Receives and emits emissions until the sender closes the
+        connection
+        """
+        while self.receive() is not None:
+            pass
+
+    def close(self):
+        self.connection.close()
+
+# vim: et sw=4 ts=4 tw=80:
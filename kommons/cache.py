@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+""" A persistent cache for the results of deterministic processes """
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from kommons.errors import KommonRuntimeError
+from kommons.path import Directory, File
+from kommons.process import ProcessTimeoutError, SubprocessError
+from kommons.store import ContentStore
+
+
+class ProcessCacheError(KommonRuntimeError):
+    pass
+
+
+class CachedResult(object):
+    """ Result of a process run through a ProcessCache """
+
+    def __init__(self, cmd, returncode, stdout, hit, result=None):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.hit = hit
+        self.result = result
+
+    def get_stdout(self):
+        """ Returns the output of the process as string """
+        with open(self.stdout.get_name(), "rb") as f:
+            return f.read()
+
+
+def _resolve(file, cwd):
+    # files are given relative to the working directory of the process
+    if isinstance(file, File):
+        file = file.get_name()
+    return os.path.join(cwd or os.curdir, file)
+
+
+class ProcessCache(object):
+    """ Caches stdout, return code and output files of processes
+
+    The cache key is built from the command, the values of the environment
+    variables in env_keys, the inputdata and the content of the declared input
+    files. On a hit no process is spawned at all. Only deterministic
+    processes must be run through the cache.
+
+    Output files are stored deduplicated in a ContentStore. If max_size is set
+    the least recently used entries are evicted to keep the cache below
+    max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=None, env_keys=None):
+        if not isinstance(directory, Directory):
+            directory = Directory(directory)
+        self.directory = directory
+        self.max_size = max_size
+        self.env_keys = sorted(env_keys or [])
+        self.store = ContentStore(directory + "store")
+        self.entries = directory + "entries"
+        self.tmp = directory + "tmp"
+        self.entries.create()
+        self.tmp.create()
+        self.lock = threading.Lock()
+        # serializes linking blobs into entries and removing unreferenced
+        # blobs
+        self.blob_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_key(self, process, inputdata=None, inputs=None, extra_env=None,
+                env=None, cwd=None):
+        """ Returns the cache key of a process invocation
+
+        inputdata must be a string or a kommons.path.File. Streams can't be
+        hashed without consuming them. Relative input files are resolved
+        against cwd.
+        """
+        if env is None:
+            env = os.environ
+        env = dict(env)
+        env.update(extra_env or {})
+        cwd = os.path.abspath(cwd or os.curdir)
+        if isinstance(inputdata, File):
+            inputdata = self.store.hash_file(_resolve(inputdata, cwd))
+        elif inputdata is not None:
+            if isinstance(inputdata, type(u"")):
+                inputdata = inputdata.encode("utf-8")
+            elif not isinstance(inputdata, bytes):
+                raise ProcessCacheError("inputdata of a cached process must "
+                                        "be a string or a File, not %s" %
+                                        type(inputdata).__name__)
+            inputdata = hashlib.sha1(inputdata).hexdigest()
+        key = {
+            "cmd": process.cmd,
+            "cwd": cwd,
+            "env": [(k, env.get(k)) for k in self.env_keys],
+            "inputdata": inputdata,
+            "inputs": [(str(f), self.store.hash_file(_resolve(f, cwd)))
+                       for f in inputs or []],
+        }
+        data = json.dumps(key, sort_keys=True).encode("utf-8")
+        return hashlib.sha1(data).hexdigest()
+
+    def _get_entry(self, key):
+        return self.entries + Directory(os.path.join(key[:2], key[2:]))
+
+    def _load(self, key):
+        entry = self._get_entry(key)
+        result = os.path.join(entry.get_name(), "result")
+        try:
+            with open(result) as f:
+                data = json.load(f)
+            os.utime(result, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return entry, data
+
+    def _store(self, file, dest):
+        # an unreferenced blob must not be evicted between put and link
+        with self.blob_lock:
+            digest = self.store.put(file)
+            self.store.link(digest, dest.get_name())
+
+    def _save(self, key, returncode, stdout, outputs):
+        tmp = Directory(tempfile.mkdtemp(dir=self.tmp.get_name()))
+        try:
+            files = []
+            self._store(stdout, tmp + "stdout")
+            for i, output in enumerate(outputs):
+                self._store(output, tmp + str(i))
+                files.append(str(output))
+            with open((tmp + "result").get_name(), "w") as f:
+                json.dump({"returncode": returncode, "outputs": files}, f)
+            entry = self._get_entry(key)
+            Directory(os.path.dirname(entry.get_name())).create()
+            try:
+                os.rename(tmp.get_name(), entry.get_name())
+            except OSError as e:
+                # another process has stored the same entry in the meantime
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            tmp.delete()
+
+    def run(self, process, inputdata=None, inputs=None, outputs=None,
+            extra_env=None, **kw):
+        """ Runs process or returns its cached result
+
+        :param inputdata A string or a kommons.path.File to pass as stdin
+        :param inputs List of input files. Their content is part of the key.
+        :param outputs List of files written by process. They are stored in
+                       the cache and restored on a hit.
+
+        Relative input and output files are resolved against the cwd
+        argument of the process.
+
+        Returns a CachedResult. stdout of the process is always captured and
+        accessible via the CachedResult. Like Process.run a SubprocessError is
+        raised if the return code is not 0, even for a cache hit.
+        """
+        cwd = kw.get("cwd")
+        outputs = [File(_resolve(f, cwd)) for f in outputs or []]
+        key = self.get_key(process, inputdata, inputs, extra_env,
+                           kw.get("env"), cwd)
+        cached = self._load(key)
+        if cached is not None:
+            with self.lock:
+                self.hits += 1
+            entry, data = cached
+            for i, output in enumerate(outputs):
+                directory = output.get_directory()
+                if directory:
+                    directory.create()
+                shutil.copyfile((entry + str(i)).get_name(),
+                                output.get_name())
+            returncode = data["returncode"]
+            if returncode != 0:
+                raise SubprocessError(process.cmd, returncode)
+            return CachedResult(process.cmd, returncode,
+                                File((entry + "stdout").get_name()), True)
+
+        with self.lock:
+            self.misses += 1
+        fd, stdout = tempfile.mkstemp(dir=self.tmp.get_name())
+        try:
+            error = None
+            with os.fdopen(fd, "wb") as f:
+                try:
+                    result = process.run(inputdata=inputdata,
+                                         extra_env=extra_env, stdout=f, **kw)
+                    returncode = result.returncode
+                except SubprocessError as e:
+                    error = e
+                    returncode = e.returncode
+            # don't cache killed or timed out processes and processes which
+            # couldn't be started. the output contains the reason in the
+            # latter case. a timed out process may have trapped SIGTERM and
+            # exited with a non-negative return code.
+            if returncode >= 0 and not isinstance(error,
+                                                  ProcessTimeoutError) and \
+                    (error is None or error.output is None):
+                self._save(key, returncode, stdout, outputs)
+                if self.max_size is not None:
+                    self.evict()
+            if error:
+                raise error
+        finally:
+            os.remove(stdout)
+        entry = self._get_entry(key)
+        return CachedResult(process.cmd, returncode,
+                            File((entry + "stdout").get_name()), False,
+                            result)
+
+    def _iter_entries(self):
+        entries = self.entries.get_name()
+        for prefix in os.listdir(entries):
+            for name in os.listdir(os.path.join(entries, prefix)):
+                entry = os.path.join(entries, prefix, name)
+                try:
+                    mtime = os.stat(os.path.join(entry, "result")).st_mtime
+                except OSError:
+                    continue
+                yield mtime, entry
+
+    def evict(self, max_size=None):
+        """ Removes least recently used entries until the cache is below
+        max_size bytes. If max_size is not set the max_size of the cache is
+        used. Returns the number of removed entries.
+        """
+        if max_size is None:
+            max_size = self.max_size or 0
+        removed = 0
+        size = self.store.size()
+        with self.blob_lock:
+            for mtime, entry in sorted(self._iter_entries()):
+                if size <= max_size:
+                    break
+                digests = []
+                for name in os.listdir(entry):
+                    path = os.path.join(entry, name)
+                    st = os.stat(path)
+                    # the blob is only linked by the store and this entry
+                    if name != "result" and st.st_nlink == 2:
+                        size -= st.st_size
+                        digests.append(self.store.hash_file(path))
+                Directory(entry).delete()
+                removed += 1
+                # remove only the blobs of this entry which aren't referenced
+                # anymore
+                for digest in digests:
+                    try:
+                        if self.store.refcount(digest) == 0:
+                            self.store.remove(digest)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+        with self.lock:
+            self.evictions += removed
+        return removed
+
+    def clear(self):
+        """ Removes all entries and unreferenced blobs """
+        self.evict(0)
+        with self.blob_lock:
+            self.store.gc(0)
+
+    def get_stats(self):
+        """ Returns a dict with the number of hits, misses and evictions """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+# vim: et sw=4 ts=4 tw=80:
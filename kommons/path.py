@@ -27,6 +27,11 @@ import os
 import shutil
 import tempfile
 
+try:
+    basestring
+except NameError:
+    basestring = str
+
 
 class Directory(object):
     """Handle directories on filesystems """
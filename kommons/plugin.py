@@ -19,19 +19,119 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301 USA
 
+import abc
+import argparse
+import ast
+import binascii
+import collections
+import contextlib
+import errno
+import hashlib
 import imp
 import inspect
+import json
 import logging
+import marshal
+import os
 import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import importlib.machinery
+    import importlib.util
+    spec_from_file_location = importlib.util.spec_from_file_location
+except (ImportError, AttributeError):
+    # python < 3.4
+    spec_from_file_location = None
+
+from kommons.signals import Signal
 
 logger = logging.getLogger(__name__)
 
+clock = getattr(time, "perf_counter", time.time)
+
+
+class ClassIndex(object):
+    """ An index of the classes of a python module
+
+    Contains a mapping of the class names to the classes and a mapping of each
+    class in the MRO of the classes to its subclasses in the module.
+    """
+
+    def __init__(self, module, all=False):
+        """ Creates a new ClassIndex instance
+
+        :param module The python module to index
+        :param all If False only classes from module are indexed. Imported
+                   classes are excluded in that case.
+        """
+        self.classes = []
+        self.names = {}
+        self.subclasses = {}
+        self.virtual = {}
+        for key, value in module.__dict__.items():
+            if not inspect.isclass(value):
+                continue
+            # only load classes from module
+            if not all and value.__module__ != module.__name__:
+                logger.debug("Skipping class '%s'" % value)
+                continue
+            logger.debug("Found class '%s'" % value)
+            self.classes.append(value)
+            self.names.setdefault(value.__name__, value)
+            for cls in inspect.getmro(value):
+                self.subclasses.setdefault(cls, []).append(value)
+
+    def get_subclasses(self, parentclass):
+        """ Returns the indexed classes that are a subclass of parentclass """
+        if isinstance(parentclass, abc.ABCMeta):
+            # abstract base classes may have virtual subclasses that are not
+            # part of the MRO
+            classes = self.virtual.get(parentclass)
+            if classes is None:
+                classes = [cls for cls in self.classes
+                           if issubclass(cls, parentclass)]
+                self.virtual[parentclass] = classes
+            return classes
+        return self.subclasses.get(parentclass, [])
+
 
 class Module(object):
 
     def __init__(self, module, source=None):
         self.module = module
         self.source = source
+        self.indexes = {}
+
+    def get_index(self, all=False):
+        """ Returns the ClassIndex of the module
+
+        The index is created on first use and kept until the module is
+        reloaded.
+        """
+        index = self.indexes.get(all)
+        if index is None:
+            index = ClassIndex(self.module, all)
+            self.indexes[all] = index
+        return index
+
+    def invalidate(self):
+        """ Drops the class indexes of the module """
+        self.indexes = {}
+
+    def reload(self):
+        """ Reloads the python module """
+        self.invalidate()
+        self.module = imp.reload(self.module)
+        return self.module
 
     def get_classes(self, parentclass=None, all=False):
         """
@@ -41,69 +141,276 @@ class Module(object):
         :param all If False only classes from module are returned. Imported
                    classes are excluded in that case.
         """
-        classes = []
-        for key, value in self.module.__dict__.items():
-            if inspect.isclass(value):
-                if parentclass:
-                    if not issubclass(value, parentclass):
-                        continue
-                # only load classes from module
-                if not all and value.__module__ != self.module.__name__:
-                    logger.debug("Skipping class '%s'" % value)
-                    continue
-                logger.debug("Found class '%s'" % value)
-                classes.append(value)
-        return classes
+        index = self.get_index(all)
+        if parentclass:
+            return list(index.get_subclasses(parentclass))
+        return list(index.classes)
 
     def get_class(self, classname):
         """
         Returns the class from the module with name classname or None if not
         found.
         """
-        classes = self.get_classes()
-        if not classes:
-            return None
-        for cls in classes:
-            if cls.__name__ == classname:
-                return cls
-        return None
+        return self.get_index().names.get(classname)
 
     def get_source(self):
         return self.source
 
 
+def _get_traced_memory():
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[0]
+
+
+class ImportStats(object):
+    """ Durations of the phases of a module import """
+
+    phases = ("find", "read", "compile", "exec")
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.times = dict((phase, 0.0) for phase in self.phases)
+        self.imports = 0
+        self.memory = None
+        self.error = None
+        self._modules = len(sys.modules)
+        self._memory = _get_traced_memory()
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.times[phase] += clock() - start
+
+    def finish(self):
+        # modules added to sys.modules except the imported module itself
+        imports = len(sys.modules) - self._modules
+        if self.name in sys.modules:
+            imports -= 1
+        self.imports = max(imports, 0)
+        memory = _get_traced_memory()
+        if memory is not None and self._memory is not None:
+            self.memory = memory - self._memory
+
+    def get_total(self):
+        return sum(self.times.values())
+
+    def to_dict(self):
+        data = {"name": self.name, "loader": self.loader,
+                "total": self.get_total(), "imports": self.imports,
+                "memory": self.memory, "error": self.error}
+        data.update(self.times)
+        return data
+
+
+class ImportProfiler(object):
+    """ Records the import times of plugin modules
+
+    Set it as profiler of a FileLoader or StringLoader instance or class. For
+    each imported module the durations of finding, reading, compiling and
+    executing the module, the number of modules imported while executing it
+    and with trace_memory the growth of the allocated memory are recorded.
+    The memory is only traced with python >= 3.4. With older versions
+    compiling source modules is reported as part of exec. Compiling means
+    loading the code from the bytecode cache if it's up to date.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.stats = []
+        self.lock = threading.Lock()
+        self.tracing = False
+        if trace_memory and tracemalloc is not None and \
+                not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+    def start(self, name, loader):
+        """ Returns a new ImportStats instance for the import of name """
+        return ImportStats(name, loader.__class__.__name__)
+
+    def add(self, stats):
+        stats.finish()
+        with self.lock:
+            self.stats.append(stats)
+
+    def snapshot(self):
+        """ Returns a list of dicts with the statistics of all imports sorted
+        by their total time
+        """
+        with self.lock:
+            stats = [s.to_dict() for s in self.stats]
+        return sorted(stats, key=lambda s: s["total"], reverse=True)
+
+    def export(self, filename=None):
+        """ Returns the snapshot as JSON string and writes it to filename if
+        set
+        """
+        data = json.dumps(self.snapshot(), indent=2)
+        if filename:
+            with open(filename, "w") as f:
+                f.write(data)
+        return data
+
+    def reset(self):
+        with self.lock:
+            self.stats = []
+
+    def stop(self):
+        """ Stops tracing the memory if it has been started by the profiler
+        """
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+
+class LazyModule(Module):
+    """ A Module that is imported on first use
+
+    The python module is imported when the module attribute is accessed the
+    first time e.g. by get_class or get_classes. Concurrent first accesses
+    import the module only once. The source is only read by get_source.
+    """
+
+    def __init__(self, loader, fullname, as_module):
+        self.loader = loader
+        self.fullname = fullname
+        self.as_module = as_module
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self._module = None
+        self._source = None
+
+    @property
+    def module(self):
+        module = self._module
+        if module is None:
+            with self.lock:
+                if self._module is None:
+                    self._module = self.loader.import_module(self.fullname,
+                                                             self.as_module)
+                module = self._module
+        return module
+
+    @module.setter
+    def module(self, module):
+        self._module = module
+
+    def is_loaded(self):
+        return self._module is not None
+
+    @property
+    def source(self):
+        return self.get_source()
+
+    def get_source(self):
+        if self._source is None:
+            with self.lock:
+                if self._source is None:
+                    self._source = self.loader.read_source(self.fullname)
+        return self._source
+
+
 class FileLoader(object):
 
     """
     A module loader class to load modules from "normal" .py files
     """
 
-    def __init__(self, paths=None):
+    profiler = None
+
+    def __init__(self, paths=None, lazy=False):
+        """
+        :param paths List of directories to search the modules in
+        :param lazy If True load_module returns LazyModule instances that
+                    import the modules on first use
+        """
         self.paths = paths
+        self.lazy = lazy
 
     def add_path(self, path):
         """
         Adds a path to the module search path
         """
-        if self.path is None:
-            self.path = []
+        if self.paths is None:
+            self.paths = []
         self.paths.append(path)
 
     def add_paths(self, paths):
         """
         Adds a path list to the module search path
         """
-        if self.path is None:
-            self.path = []
+        if self.paths is None:
+            self.paths = []
         self.paths.extend(paths)
 
+    def _exec_source(self, as_module, pathname, stats):
+        # does the same as imp.load_module for source modules but gets the
+        # code and executes it in separate steps to measure both. the code is
+        # read from the bytecode cache if it's up to date.
+        loader = importlib.machinery.SourceFileLoader(as_module, pathname)
+        spec = spec_from_file_location(as_module, pathname, loader=loader)
+        module = importlib.util.module_from_spec(spec)
+        with stats.measure("compile"):
+            code = loader.get_code(as_module)
+        sys.modules[as_module] = module
+        try:
+            with stats.measure("exec"):
+                exec(code, module.__dict__)
+        except:
+            sys.modules.pop(as_module, None)
+            raise
+        return sys.modules[as_module]
+
+    def _profile_import(self, module_name, paths, as_module, read_source):
+        stats = self.profiler.start(as_module, self)
+        try:
+            with stats.measure("find"):
+                f, pathname, description = imp.find_module(module_name,
+                                                           paths)
+            try:
+                source = None
+                if f and read_source:
+                    with stats.measure("read"):
+                        source = f.read()
+                        f.seek(0)
+                if description[2] == imp.PY_SOURCE and \
+                        spec_from_file_location is not None:
+                    module = self._exec_source(as_module, pathname, stats)
+                else:
+                    # compiling and executing can't be measured separately.
+                    # the whole import is reported as exec.
+                    with stats.measure("exec"):
+                        module = imp.load_module(as_module, f, pathname,
+                                                 description)
+            finally:
+                if f:
+                    f.close()
+        except Exception as error:
+            stats.error = str(error)
+            raise
+        finally:
+            self.profiler.add(stats)
+
+        logger.debug("Imported module '%s'" % module)
+
+        return module, source
+
     def _load_module(self, module_name, paths, as_module=None):
         if not as_module:
             as_module = module_name
+        if self.profiler is not None:
+            return Module(*self._profile_import(module_name, paths,
+                                                as_module, True))
         f, pathname, description = imp.find_module(module_name, paths)
         try:
-            source = f.read()
-            f.seek(0)
+            source = None
+            if f:
+                source = f.read()
+                f.seek(0)
             module = imp.load_module(as_module, f, pathname, description)
         finally:
             if f:
@@ -113,41 +420,202 @@ class FileLoader(object):
 
         return Module(module, source)
 
+    def _unload(self, as_module):
+        if as_module in sys.modules:
+            logger.warn("Reloading '%s' module. This overwrites the "
+                        "previous loaded module with the same name." %
+                        as_module)
+            del sys.modules[as_module]
+
+    def import_module(self, fullname, as_module=None):
+        """
+        Imports a python module by its name without reading its source
+
+        Returns the python module. Raises an ImportError if the module can't
+        be imported.
+        """
+        if not as_module:
+            as_module = fullname
+        self._unload(as_module)
+        if self.profiler is not None:
+            return self._profile_import(fullname, self.paths, as_module,
+                                        False)[0]
+        f, pathname, description = imp.find_module(fullname, self.paths)
+        try:
+            module = imp.load_module(as_module, f, pathname, description)
+        finally:
+            if f:
+                f.close()
+
+        logger.debug("Imported module '%s'" % module)
+
+        return module
+
+    def get_filename(self, fullname):
+        """
+        Returns the name of the source file of a module or None if it hasn't
+        a source file
+        """
+        f, pathname, description = imp.find_module(fullname, self.paths)
+        if f:
+            f.close()
+        if description[2] == imp.PY_SOURCE:
+            return pathname
+        if description[2] == imp.PKG_DIRECTORY:
+            filename = os.path.join(pathname, "__init__.py")
+            if os.path.isfile(filename):
+                return filename
+        return None
+
+    def read_source(self, fullname):
+        """
+        Returns the source of a module or None if it hasn't a source file
+        """
+        filename = self.get_filename(fullname)
+        if filename is None:
+            return None
+        with open(filename) as f:
+            return f.read()
+
     def load_module(self, fullname, as_module=None):
         """
         Loads a python module by its name
 
         If found the module is stored as as_module if set or fullname otherwise.
+        Returns None if the module can't be found or imported. In lazy mode the
+        module is only searched and not imported until it is used.
         """
         if not as_module:
             as_module = fullname
         try:
-            if as_module in sys.modules:
-                logger.warn("Reloading '%s' module. This overwrites the "
-                            "previous loaded module with the same name." %
-                            as_module)
-                del sys.modules[as_module]
+            if self.lazy:
+                f, pathname, description = imp.find_module(fullname,
+                                                           self.paths)
+                if f:
+                    f.close()
+                return LazyModule(self, fullname, as_module)
+            self._unload(as_module)
             return self._load_module(fullname, self.paths, as_module)
-        except ImportError, error:
+        except ImportError as error:
             logger.warn("Could not import module '%s'. %s" % (fullname, error))
             return None
 
 
+class CodeCache(object):
+    """ A cache of compiled code objects
+
+    Code objects are keyed by the hash of the filename, the source and the
+    magic number of the python bytecode. The most recently used code objects
+    are kept in memory. If a directory is set the code objects are also
+    stored as marshal files in it and can be shared between processes.
+    """
+
+    def __init__(self, size=256, directory=None):
+        """ Creates a new CodeCache instance
+
+        :param size Maximum number of code objects to keep in memory
+        :param directory Optional directory to store the code objects in
+        """
+        self.size = size
+        self.directory = directory
+        self.codes = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, source, filename):
+        if not isinstance(source, bytes):
+            source = source.encode("utf-8")
+        h = hashlib.sha1(imp.get_magic())
+        h.update(filename.encode("utf-8"))
+        h.update(b"\0")
+        h.update(source)
+        return h.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + ".code")
+
+    def _load(self, key):
+        try:
+            with open(self._get_path(key), "rb") as f:
+                return marshal.loads(f.read())
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except (EOFError, ValueError, TypeError):
+            logger.warn("Ignoring invalid cached code '%s'" %
+                        self._get_path(key))
+        return None
+
+    def _save(self, key, code):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmpname = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(marshal.dumps(code))
+            os.rename(tmpname, self._get_path(key))
+        except:
+            os.remove(tmpname)
+            raise
+
+    def get_code(self, source, filename):
+        """ Returns the code object of source. It is compiled if it's not
+        cached yet.
+        """
+        key = self.get_key(source, filename)
+        with self.lock:
+            code = self.codes.pop(key, None)
+            if code is not None:
+                self.codes[key] = code
+                self.hits += 1
+                return code
+        code = None
+        if self.directory:
+            code = self._load(key)
+        if code is None:
+            code = compile(source, filename, "exec", dont_inherit=True)
+            if self.directory:
+                self._save(key, code)
+        with self.lock:
+            self.misses += 1
+            self.codes[key] = code
+            while len(self.codes) > self.size:
+                self.codes.popitem(last=False)
+        return code
+
+    def clear(self):
+        """ Drops all code objects from memory """
+        with self.lock:
+            self.codes.clear()
+
+
+code_cache = CodeCache()
+
+
 class StringLoader(object):
 
     """
     Load a python module from a String
     """
 
-    def __init__(self, source):
+    profiler = None
+
+    def __init__(self, source, cache=None):
+        """
+        :param source The source code of the module
+        :param cache CodeCache for the compiled source. If not set a cache
+                     shared by all StringLoaders is used.
+        """
         self.source = source
+        self.cache = cache or code_cache
 
     def get_source(self, fullname):
         return self.source
 
     def get_code(self, fullname):
         source = self.get_source(fullname)
-        return compile(source, self.get_filename(), "exec", dont_inherit=True)
+        return self.cache.get_code(source, self.get_filename(fullname))
 
     def get_filename(self, fullname):
         return "<%s>" % self.__class__.__name__
@@ -155,18 +623,731 @@ class StringLoader(object):
     def is_package(self, fullname):
         return False
 
-    def load_module(self, fullname):
-        source = self.get_source(fullname)
+    def _new_module(self, fullname):
         ispkg = self.is_package(fullname)
         mod = sys.modules.setdefault(fullname, imp.new_module(fullname))
-        mod.__file__ = self.get_filename()
+        mod.__file__ = self.get_filename(fullname)
         mod.__loader__ = self
         if ispkg:
             mod.__path__ = []
             mod.__package__ = fullname
         else:
             mod.__package__ = fullname.rpartition('.')[0]
-        exec(source, mod.__dict__)
+        return mod
+
+    def _profile_load(self, fullname):
+        stats = self.profiler.start(fullname, self)
+        try:
+            with stats.measure("read"):
+                source = self.get_source(fullname)
+            with stats.measure("compile"):
+                code = self.get_code(fullname)
+            mod = self._new_module(fullname)
+            with stats.measure("exec"):
+                exec(code, mod.__dict__)
+        except Exception as error:
+            stats.error = str(error)
+            raise
+        finally:
+            self.profiler.add(stats)
         return Module(mod, source)
 
+    def load_module(self, fullname):
+        if self.profiler is not None:
+            return self._profile_load(fullname)
+        source = self.get_source(fullname)
+        code = self.get_code(fullname)
+        mod = self._new_module(fullname)
+        exec(code, mod.__dict__)
+        return Module(mod, source)
+
+
+BUNDLE_INDEX = "__index__"
+BUNDLE_VERSION = 1
+
+
+def _get_bundle_modules(directory, relpath="", prefix=""):
+    modules = []
+    for name in sorted(os.listdir(os.path.join(directory, relpath))):
+        path = os.path.join(relpath, name)
+        fullpath = os.path.join(directory, path)
+        if name.endswith(".py") and os.path.isfile(fullpath):
+            if name != "__init__.py":
+                modules.append((prefix + name[:-3], path, False))
+        elif os.path.isfile(os.path.join(fullpath, "__init__.py")):
+            modules.append((prefix + name, os.path.join(path, "__init__.py"),
+                            True))
+            modules.extend(_get_bundle_modules(directory, path,
+                                               prefix + name + "."))
+    return modules
+
+
+def build_bundle(directory, filename, sources=True):
+    """ Builds a bundle for a BundleLoader from the plugin modules in
+    directory
+
+    All modules and packages in directory including the modules of the
+    packages are compiled and stored in a zip file together with an index.
+    The code objects can only be used by the python version that has built
+    the bundle. With sources the modules can still be loaded by other
+    versions. Returns the names of the bundled modules.
+    """
+    index = {"version": BUNDLE_VERSION,
+             "magic": binascii.hexlify(imp.get_magic()).decode("ascii"),
+             "modules": {}}
+    tmpname = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        with zipfile.ZipFile(tmpname, "w", zipfile.ZIP_STORED) as bundle:
+            for name, relpath, package in _get_bundle_modules(directory):
+                with open(os.path.join(directory, relpath), "rb") as f:
+                    source = f.read()
+                code = compile(source, os.path.join(filename, relpath),
+                               "exec", dont_inherit=True)
+                bundle.writestr("code/" + name, marshal.dumps(code))
+                if sources:
+                    bundle.writestr("source/" + name, source)
+                index["modules"][name] = {"filename": relpath,
+                                          "package": package,
+                                          "source": sources}
+            bundle.writestr(BUNDLE_INDEX, json.dumps(index))
+        os.rename(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    return sorted(index["modules"])
+
+
+_bundles = {}
+_bundles_lock = threading.Lock()
+
+
+def _bundle_path_hook(path):
+    """ Returns a BundleFinder for the __path__ entries of bundled packages
+    """
+    for filename, loader in list(_bundles.items()):
+        if path.startswith(filename + os.sep):
+            package = path[len(filename) + 1:].replace(os.sep, ".")
+            return BundleFinder(loader, package)
+    raise ImportError("%s is not a package in a bundle" % path)
+
+
+class BundleModuleLoader(object):
+    """ Imports a submodule of a bundled package """
+
+    def __init__(self, loader, name):
+        self.loader = loader
+        self.name = name
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        self.loader._init_module(self.name, module, self)
+        exec(self.loader.get_code(self.name), module.__dict__)
+
+    def load_module(self, fullname):
+        # python 2
+        return self.loader._exec(self.name, fullname,
+                                 self.loader.get_code(self.name), self)
+
+    def is_package(self, fullname):
+        return self.loader.is_package(self.name)
+
+    def get_source(self, fullname):
+        return self.loader.read_source(self.name)
+
+
+class BundleFinder(object):
+    """ Finds the submodules of a package in a bundle """
+
+    def __init__(self, loader, package):
+        self.loader = loader
+        self.package = package
+
+    def _get_name(self, fullname):
+        name = "%s.%s" % (self.package, fullname.rpartition(".")[2])
+        if name in self.loader._open():
+            return name
+        return None
+
+    def find_module(self, fullname, path=None):
+        name = self._get_name(fullname)
+        if name is None:
+            return None
+        return BundleModuleLoader(self.loader, name)
+
+    def find_spec(self, fullname, target=None):
+        name = self._get_name(fullname)
+        if name is None:
+            return None
+        spec = importlib.util.spec_from_loader(
+            fullname, BundleModuleLoader(self.loader, name),
+            origin=self.loader.get_filename(name),
+            is_package=self.loader.is_package(name))
+        if spec.submodule_search_locations is not None:
+            spec.submodule_search_locations.append(
+                self.loader._get_path_entry(name))
+        return spec
+
+    def invalidate_caches(self):
+        pass
+
+
+class BundleLoader(object):
+
+    """
+    Load python modules from a bundle created by build_bundle
+
+    The bundle is opened once and its index is kept in memory. Therefore
+    loading a module doesn't search any paths. The precompiled code objects
+    are used if the bundle has been built with the running python version.
+    Bundled packages can import their submodules like from the file system.
+    """
+
+    profiler = None
+
+    def __init__(self, filename, lazy=False):
+        """
+        :param filename Name of the bundle file
+        :param lazy If True load_module returns LazyModule instances that
+                    import the modules on first use
+        """
+        self.filename = os.path.abspath(filename)
+        self.lazy = lazy
+        self.lock = threading.Lock()
+        self.bundle = None
+        self.modules = None
+        self.compiled = False
+
+    def _open(self):
+        with self.lock:
+            if self.bundle is None:
+                bundle = zipfile.ZipFile(self.filename)
+                index = json.loads(bundle.read(BUNDLE_INDEX).decode("utf-8"))
+                magic = binascii.hexlify(imp.get_magic()).decode("ascii")
+                self.compiled = index["magic"] == magic
+                self.modules = index["modules"]
+                self.bundle = bundle
+                with _bundles_lock:
+                    _bundles[self.filename] = self
+                    if _bundle_path_hook not in sys.path_hooks:
+                        # before zipimport which would claim the paths
+                        sys.path_hooks.insert(0, _bundle_path_hook)
+        return self.modules
+
+    def _read(self, member):
+        # the members share the file object of the zip file
+        with self.lock:
+            return self.bundle.read(member)
+
+    def _get_entry(self, fullname):
+        entry = self._open().get(fullname)
+        if entry is None:
+            raise ImportError("No module named %s in %s" % (fullname,
+                                                            self.filename))
+        return entry
+
+    def get_module_names(self):
+        """ Returns the names of all modules in the bundle """
+        return sorted(self._open())
+
+    def get_filename(self, fullname):
+        return os.path.join(self.filename,
+                            self._get_entry(fullname)["filename"])
+
+    def is_package(self, fullname):
+        return self._get_entry(fullname)["package"]
+
+    def read_source(self, fullname):
+        """
+        Returns the source of a module or None if the bundle doesn't contain
+        the sources
+        """
+        if not self._get_entry(fullname)["source"]:
+            return None
+        return self._read("source/" + fullname).decode("utf-8")
+
+    get_source = read_source
+
+    def get_code(self, fullname):
+        self._get_entry(fullname)
+        if self.compiled:
+            return marshal.loads(self._read("code/" + fullname))
+        source = self.read_source(fullname)
+        if source is None:
+            raise ImportError("Bundle %s has been built by another python "
+                              "version and doesn't contain the source of %s"
+                              % (self.filename, fullname))
+        return compile(source, self.get_filename(fullname), "exec",
+                       dont_inherit=True)
+
+    def _get_path_entry(self, fullname):
+        return os.path.join(self.filename, *fullname.split("."))
+
+    def _init_module(self, fullname, module, loader):
+        module.__file__ = self.get_filename(fullname)
+        module.__loader__ = loader
+        if self.is_package(fullname):
+            module.__path__ = [self._get_path_entry(fullname)]
+            module.__package__ = module.__name__
+        else:
+            module.__package__ = module.__name__.rpartition('.')[0]
+
+    def _exec(self, fullname, as_module, code, loader=None):
+        module = imp.new_module(as_module)
+        self._init_module(fullname, module, loader or self)
+        if as_module in sys.modules:
+            logger.warn("Reloading '%s' module. This overwrites the "
+                        "previous loaded module with the same name." %
+                        as_module)
+        sys.modules[as_module] = module
+        try:
+            exec(code, module.__dict__)
+        except:
+            sys.modules.pop(as_module, None)
+            raise
+        return sys.modules[as_module]
+
+    def _profile_import(self, fullname, as_module):
+        stats = self.profiler.start(as_module, self)
+        try:
+            with stats.measure("find"):
+                self._get_entry(fullname)
+            if self.compiled:
+                with stats.measure("read"):
+                    data = self._read("code/" + fullname)
+                with stats.measure("compile"):
+                    code = marshal.loads(data)
+            else:
+                with stats.measure("compile"):
+                    code = self.get_code(fullname)
+            with stats.measure("exec"):
+                module = self._exec(fullname, as_module, code)
+        except Exception as error:
+            stats.error = str(error)
+            raise
+        finally:
+            self.profiler.add(stats)
+        return module
+
+    def import_module(self, fullname, as_module=None):
+        """
+        Imports a python module from the bundle
+
+        Returns the python module. Raises an ImportError if the module isn't
+        in the bundle.
+        """
+        if not as_module:
+            as_module = fullname
+        if self.profiler is not None:
+            module = self._profile_import(fullname, as_module)
+        else:
+            module = self._exec(fullname, as_module, self.get_code(fullname))
+
+        logger.debug("Imported module '%s'" % module)
+
+        return module
+
+    def load_module(self, fullname, as_module=None):
+        """
+        Loads a python module from the bundle
+
+        If found the module is stored as as_module if set or fullname otherwise.
+        The source of the module is only read by get_source of the returned
+        Module.
+        """
+        if not as_module:
+            as_module = fullname
+        module = LazyModule(self, fullname, as_module)
+        try:
+            if self.lazy:
+                self._get_entry(fullname)
+                return module
+            module.module = self.import_module(fullname, as_module)
+        except ImportError as error:
+            logger.warn("Could not import module '%s'. %s" % (fullname, error))
+            return None
+        return module
+
+    def close(self):
+        with self.lock:
+            if self.bundle is not None:
+                self.bundle.close()
+                self.bundle = None
+                with _bundles_lock:
+                    if _bundles.get(self.filename) is self:
+                        del _bundles[self.filename]
+
+
+def get_dotted_name(node):
+    """ Returns the dotted name of a ast Name or Attribute node or None """
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        name = get_dotted_name(node.value)
+        if name is not None:
+            return "%s.%s" % (name, node.attr)
+    return None
+
+
+class ClassInfo(object):
+    """ Information about a class found in the source of a plugin module """
+
+    def __init__(self, scanner, module_name, name, bases, lineno):
+        self.scanner = scanner
+        self.module_name = module_name
+        self.name = name
+        self.bases = bases
+        self.lineno = lineno
+
+    def get_base_names(self):
+        """ Returns the names of the bases without module prefixes """
+        return [base.rpartition(".")[2] for base in self.bases]
+
+    def load(self):
+        """ Imports the module of the class and returns the class """
+        module = self.scanner.load_module(self.module_name)
+        if module is None:
+            return None
+        return module.get_class(self.name)
+
+    def __repr__(self):
+        return "<ClassInfo %s.%s(%s)>" % (self.module_name, self.name,
+                                          ", ".join(self.bases))
+
+
+class SourceScanner(object):
+    """ Discovers the classes of plugin modules without importing them
+
+    The sources of the modules in the search paths of a FileLoader are parsed
+    with ast. Only the top-level class statements and the names of their
+    declared bases are collected. The results are cached per file and are
+    reused as long as the modification time and size or the content hash of
+    the file doesn't change. Optionally the cache is stored in a JSON file
+    to be shared between processes. Modules are only imported when a class
+    is loaded.
+    """
+
+    cache_version = 1
+
+    def __init__(self, loader, cache_file=None):
+        """ Creates a new SourceScanner instance
+
+        :param loader FileLoader to import the modules with
+        :param cache_file Optional name of a JSON file to persist the results
+        """
+        self.loader = loader
+        self.cache_file = cache_file
+        self.cache = {}
+        self.modules = {}
+        self.dirty = False
+        if cache_file:
+            self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get("version") == self.cache_version:
+            self.cache = data["files"]
+
+    def save(self):
+        """ Writes the cache file if the cache has changed """
+        if not self.cache_file or not self.dirty:
+            return
+        tmpname = "%s.%d.tmp" % (self.cache_file, os.getpid())
+        with open(tmpname, "w") as f:
+            json.dump({"version": self.cache_version, "files": self.cache}, f)
+        os.rename(tmpname, self.cache_file)
+        self.dirty = False
+
+    def _parse(self, filename, source):
+        try:
+            tree = ast.parse(source, filename)
+        except SyntaxError as error:
+            logger.warn("Could not parse '%s'. %s" % (filename, error))
+            return []
+        classes = []
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef):
+                bases = [get_dotted_name(base) for base in node.bases]
+                classes.append([node.name, [base for base in bases if base],
+                                node.lineno])
+        return classes
+
+    def scan_file(self, filename):
+        """ Returns the classes in filename as a list of [name, bases,
+        lineno] lists
+        """
+        st = os.stat(filename)
+        entry = self.cache.get(filename)
+        if entry and entry["mtime"] == st.st_mtime and \
+                entry["size"] == st.st_size:
+            return entry["classes"]
+        with open(filename, "rb") as f:
+            source = f.read()
+        digest = hashlib.sha1(source).hexdigest()
+        if entry is None or entry["digest"] != digest:
+            logger.debug("Scanning '%s'" % filename)
+            entry = {"digest": digest, "classes": self._parse(filename,
+                                                              source)}
+        entry["mtime"] = st.st_mtime
+        entry["size"] = st.st_size
+        self.cache[filename] = entry
+        self.dirty = True
+        return entry["classes"]
+
+    def get_module_files(self):
+        """ Returns a list of (module name, filename) tuples of the modules in
+        the search paths of the loader
+        """
+        files = []
+        seen = set()
+        for path in self.loader.paths or []:
+            try:
+                names = sorted(os.listdir(path))
+            except OSError:
+                continue
+            for name in names:
+                filename = os.path.join(path, name)
+                if name.endswith(".py"):
+                    module_name = name[:-3]
+                else:
+                    module_name = name
+                    filename = os.path.join(filename, "__init__.py")
+                    if not os.path.isfile(filename):
+                        continue
+                # the first module in the paths wins like for find_module
+                if module_name in seen:
+                    continue
+                seen.add(module_name)
+                files.append((module_name, filename))
+        return files
+
+    def get_classes(self, basename=None):
+        """ Returns ClassInfo objects for the classes of all modules
+
+        :param basename If set only classes that derive from a class with
+                        this name are returned. Bases are resolved by their
+                        name within the scanned modules only.
+        """
+        classes = []
+        for module_name, filename in self.get_module_files():
+            for name, bases, lineno in self.scan_file(filename):
+                classes.append(ClassInfo(self, module_name, name, bases,
+                                         lineno))
+        self.save()
+        if basename is None:
+            return classes
+        children = {}
+        for info in classes:
+            for base in info.get_base_names():
+                children.setdefault(base, []).append(info)
+        found = []
+        names = [basename]
+        seen = set(names)
+        # a class may be reachable through several of its bases
+        found_ids = set()
+        while names:
+            for info in children.get(names.pop(0), []):
+                if id(info) not in found_ids:
+                    found_ids.add(id(info))
+                    found.append(info)
+                if info.name not in seen:
+                    seen.add(info.name)
+                    names.append(info.name)
+        return found
+
+    def load_module(self, module_name):
+        """ Imports a module once and returns it as Module """
+        module = self.modules.get(module_name)
+        if module is None:
+            module = self.loader.load_module(module_name)
+            self.modules[module_name] = module
+        return module
+
+
+class ReloadManager(object):
+    """ Reloads changed plugin modules
+
+    Tracks the source files of the modules loaded with the manager. check()
+    only stats these files and re-imports the modules whose content has
+    changed. Loaded modules that depend on a changed module are re-imported
+    too, after their dependencies. The reloaded signal is emitted with the
+    module name and the Module for each re-imported module.
+    """
+
+    def __init__(self, loader):
+        """ Creates a new ReloadManager instance
+
+        :param loader FileLoader to import the modules with
+        """
+        self.loader = loader
+        self.modules = collections.OrderedDict()
+        self.reloaded = Signal()
+
+    def _stat(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _hash(self, filename):
+        try:
+            with open(filename, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+
+    def _get_dependencies(self, name, module):
+        dependencies = set()
+        for value in module.__dict__.values():
+            if inspect.ismodule(value):
+                dependency = value.__name__
+            else:
+                dependency = getattr(value, "__module__", None)
+            if dependency != name and dependency in self.modules:
+                dependencies.add(dependency)
+        return dependencies
+
+    def _is_loaded(self, module):
+        return not isinstance(module, LazyModule) or module.is_loaded()
+
+    def _update_dependencies(self):
+        for name, entry in self.modules.items():
+            module = entry["module"]
+            if self._is_loaded(module):
+                entry["dependencies"] = self._get_dependencies(
+                    name, module.module)
+            else:
+                entry["dependencies"] = set()
+
+    def _track(self, name, fullname, module):
+        filename = self.loader.get_filename(fullname)
+        self.modules[name] = {
+            "fullname": fullname,
+            "module": module,
+            "filename": filename,
+            "stat": filename and self._stat(filename),
+            "digest": filename and self._hash(filename),
+        }
+        self._update_dependencies()
+
+    def load_module(self, fullname, as_module=None):
+        """ Loads a module with the loader and tracks its source file """
+        name = as_module or fullname
+        entry = self.modules.get(name)
+        if entry is not None:
+            return entry["module"]
+        module = self.loader.load_module(fullname, as_module)
+        if module is not None:
+            self._track(name, fullname, module)
+        return module
+
+    def get_changed(self):
+        """ Returns the names of the modules whose source has changed """
+        changed = []
+        for name, entry in self.modules.items():
+            filename = entry["filename"]
+            if not filename:
+                continue
+            st = self._stat(filename)
+            if st == entry["stat"]:
+                continue
+            entry["stat"] = st
+            digest = self._hash(filename)
+            if digest != entry["digest"]:
+                entry["digest"] = digest
+                changed.append(name)
+        return changed
+
+    def _get_reload_order(self, changed):
+        dependents = {}
+        for name, entry in self.modules.items():
+            for dependency in entry["dependencies"]:
+                dependents.setdefault(dependency, set()).add(name)
+        names = set()
+        pending = list(changed)
+        while pending:
+            name = pending.pop()
+            if name not in names:
+                names.add(name)
+                pending.extend(dependents.get(name, ()))
+        order = []
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            visited.add(name)
+            for dependency in self.modules[name]["dependencies"]:
+                if dependency in names:
+                    visit(dependency)
+            order.append(name)
+
+        for name in self.modules:
+            if name in names:
+                visit(name)
+        return order
+
+    def _reload(self, name):
+        entry = self.modules[name]
+        if not self._is_loaded(entry["module"]):
+            # the module is imported from the changed source on first use
+            return False
+        # remove the module before importing to avoid the reload warning
+        module = entry["module"]
+        sys.modules.pop(name, None)
+        try:
+            python_module = self.loader.import_module(entry["fullname"],
+                                                      name)
+        except Exception as error:
+            logger.warn("Could not reload module '%s'. %s" % (name, error))
+            sys.modules[name] = module.module
+            return False
+        module.module = python_module
+        module.invalidate()
+        if not isinstance(module, LazyModule):
+            module.source = self.loader.read_source(entry["fullname"])
+        return True
+
+    def check(self):
+        """ Re-imports all changed modules and their dependents
+
+        Returns the names of the re-imported modules.
+        """
+        changed = self.get_changed()
+        if not changed:
+            return []
+        reloaded = []
+        for name in self._get_reload_order(changed):
+            if self._reload(name):
+                reloaded.append(name)
+        self._update_dependencies()
+        for name in reloaded:
+            logger.debug("Reloaded module '%s'" % name)
+            self.reloaded(name, self.modules[name]["module"])
+        return reloaded
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds a plugin bundle for BundleLoader")
+    parser.add_argument("directory", help="Directory of the plugin modules")
+    parser.add_argument("bundle", help="Name of the bundle file to create")
+    parser.add_argument("--no-sources", action="store_true",
+                        help="Don't include the sources of the modules")
+    args = parser.parse_args()
+    for name in build_bundle(args.directory, args.bundle,
+                             not args.no_sources):
+        print(name)
+
+
+if __name__ == "__main__":
+    main()
+
 # vim: et sw=4 ts=4 tw=80:
@@ -21,10 +21,58 @@
 
 """ This module contains classes to execute system processes """
 
+import bisect
+import collections
+import errno
 import os
+import select
+import signal
+import struct
 import subprocess
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import selectors
+except ImportError:
+    # python 2
+    selectors = None
 
 from kommons.errors import KommonRuntimeError
+from kommons.path import File
+from kommons.signals import Signal
+
+PIPE_BUF = getattr(select, "PIPE_BUF", 512)
+READ_SIZE = 32 * 1024
+
+clock = getattr(time, "monotonic", time.time)
+
+# size of a pointer in argv and envp
+POINTER_SIZE = struct.calcsize("P")
+# headroom for the argument size limit like xargs
+ARG_HEADROOM = 2048
+
+
+def _arg_size(arg):
+    if not isinstance(arg, bytes):
+        arg = arg.encode("utf-8")
+    return len(arg) + 1 + POINTER_SIZE
+
+
+def get_arg_max():
+    """ Returns the maximum size of the arguments and environment of a new
+    process
+    """
+    try:
+        return os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        return 128 * 1024
 
 
 class SubprocessError(KommonRuntimeError):
@@ -41,41 +89,1011 @@ class SubprocessError(KommonRuntimeError):
         retval = "Command %s finished with return code %d" % (self.command,
                                                               self.returncode)
         if self.output:
-            retval += "Output was: '%s'" % self.output
+            retval += ". Output was: '%s'" % self.output
         return retval
 
 
+class ProcessTimeoutError(SubprocessError):
+    """ Raised if a command has been terminated because of a timeout """
+
+    def __init__(self, command, returncode, timeout, output=None):
+        super(ProcessTimeoutError, self).__init__(command, returncode, output)
+        self.timeout = timeout
+
+    def __str__(self):
+        retval = "Command %s timed out after %.3f seconds" % (self.command,
+                                                              self.timeout)
+        if self.output:
+            retval += ". Output was: '%s'" % self.output
+        return retval
+
+
+class ProcessPoolError(SubprocessError):
+    """ Raised by a ProcessPool if one or more commands have failed """
+
+    def __init__(self, errors):
+        first = errors[0]
+        super(ProcessPoolError, self).__init__([e.command for e in errors],
+                                               first.returncode, first.output)
+        self.errors = errors
+        self.results = []
+
+    def __str__(self):
+        return "%d commands failed:\n%s" % (len(self.errors),
+                                            "\n".join([str(e) for e in
+                                                       self.errors]))
+
+
+class PipelineError(SubprocessError):
+    """ Raised by a Pipeline if one or more of its commands have failed """
+
+    def __init__(self, errors, returncodes):
+        last = errors[-1]
+        super(PipelineError, self).__init__([e.command for e in errors],
+                                            last.returncode, last.output)
+        self.errors = errors
+        self.returncodes = returncodes
+
+    def __str__(self):
+        return "Pipeline finished with return codes %s:\n%s" % (
+            self.returncodes, "\n".join([str(e) for e in self.errors]))
+
+
+class ProcessResult(object):
+    """ Return code and resource usage of a finished process """
+
+    def __init__(self, process, returncode, wall_time, rusage=None,
+                 stdout_bytes=None, stderr_bytes=None):
+        self.process = process
+        self.cmd = process.cmd
+        self.returncode = returncode
+        self.wall_time = wall_time
+        self.user_time = None
+        self.system_time = None
+        self.max_rss = None
+        if rusage is not None:
+            self.user_time = rusage.ru_utime
+            self.system_time = rusage.ru_stime
+            # ru_maxrss is in kilobytes on linux and in bytes on darwin
+            if sys.platform == "darwin":
+                self.max_rss = rusage.ru_maxrss
+            else:
+                self.max_rss = rusage.ru_maxrss * 1024
+        self.stdout_bytes = stdout_bytes
+        self.stderr_bytes = stderr_bytes
+
+    def get_name(self):
+        """ Returns the name of the executed program """
+        if isinstance(self.cmd, (list, tuple)):
+            program = self.cmd[0]
+        else:
+            program = self.cmd.split()[0]
+        return os.path.basename(program)
+
+    def get_cpu_time(self):
+        """ Returns the sum of user and system time or None if unknown """
+        if self.user_time is None:
+            return None
+        return self.user_time + self.system_time
+
+    def __str__(self):
+        return "Command %s finished with return code %d in %.3fs" % (
+            self.cmd, self.returncode, self.wall_time)
+
+
+class CommandStats(object):
+    """ Aggregated ProcessResults of a command """
+
+    def __init__(self, name, buckets):
+        self.name = name
+        self.buckets = buckets
+        self.histogram = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.failed = 0
+        self.wall_time = 0.0
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.max_rss = 0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+
+    def add(self, result):
+        self.count += 1
+        if result.returncode != 0:
+            self.failed += 1
+        self.wall_time += result.wall_time
+        self.histogram[bisect.bisect_left(self.buckets,
+                                          result.wall_time)] += 1
+        if result.user_time is not None:
+            self.user_time += result.user_time
+            self.system_time += result.system_time
+            self.max_rss = max(self.max_rss, result.max_rss)
+        self.stdout_bytes += result.stdout_bytes or 0
+        self.stderr_bytes += result.stderr_bytes or 0
+
+    def get_histogram(self):
+        """ Returns a list of (upper bound in seconds, count) tuples of the
+        wall time. The upper bound of the last bucket is None.
+        """
+        return list(zip(list(self.buckets) + [None], self.histogram))
+
+
+class ProcessStats(object):
+    """ Collects the ProcessResults of all finished processes per command
+    name
+
+    Usage:
+        stats = ProcessStats()
+        stats.connect()
+        ...
+        for command in stats.get_top("wall_time"):
+            print command.name, command.wall_time
+    """
+
+    buckets = (0.01, 0.1, 1.0, 10.0, 60.0, 600.0)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    def add(self, result):
+        name = result.get_name()
+        with self.lock:
+            stats = self.commands.get(name)
+            if stats is None:
+                stats = CommandStats(name, self.buckets)
+                self.commands[name] = stats
+            stats.add(result)
+
+    def connect(self):
+        """ Collect the results of all processes """
+        Process.finished.connect(self.add)
+
+    def disconnect(self):
+        Process.finished.disconnect(self.add)
+
+    def get_top(self, key="wall_time", count=10):
+        """ Returns the count CommandStats with the highest value of key """
+        return sorted(self.commands.values(), key=lambda c: getattr(c, key),
+                      reverse=True)[:count]
+
+
+class OutputTail(object):
+    """ A ring buffer which retains only the last size bytes of an output """
+
+    def __init__(self, size):
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+
+    def append(self, data):
+        if not data or self.size <= 0:
+            return
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def get(self):
+        """ Returns the retained output """
+        data = b"".join(self.chunks)
+        if len(data) > self.size:
+            data = data[len(data) - self.size:]
+        return data
+
+    def __len__(self):
+        return min(self.length, self.size)
+
+
+def split_lines(chunks):
+    """ Splits (name, data) chunks into (name, line) tuples. Lines are
+    buffered separately for each name and contain the trailing newline.
+    """
+    buffers = {}
+    for name, data in chunks:
+        lines = (buffers.pop(name, b"") + data).splitlines(True)
+        if lines and not lines[-1].endswith(b"\n"):
+            buffers[name] = lines.pop()
+        for line in lines:
+            yield name, line
+    for name, rest in buffers.items():
+        yield name, rest
+
+
+def new_process_group(kw):
+    """ Sets the Popen arguments kw to start the child in a new process group
+    """
+    if sys.version_info[0] < 3:
+        kw.setdefault("preexec_fn", os.setsid)
+    else:
+        kw.setdefault("start_new_session", True)
+
+
+def kill_process_group(process, sig=signal.SIGKILL):
+    """ Sends sig to the process group of process. Returns False if the group
+    doesn't exist anymore.
+    """
+    try:
+        os.killpg(process.pid, sig)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        return False
+    return True
+
+
+def reap_process_group(process):
+    """ Waits for all remaining processes of the process group of process
+    which are children of the calling process
+
+    Orphaned grandchildren only become children of the calling process if it
+    is a child subreaper. See set_child_subreaper.
+    """
+    while True:
+        try:
+            os.waitpid(-process.pid, 0)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.ECHILD:
+                raise
+            return
+
+
+def set_child_subreaper():
+    """ Makes the calling process a child subreaper (linux >= 3.4 only)
+
+    Orphaned descendants of the calling process are reparented to it instead
+    of init and can be reaped by reap_process_group. Returns False if not
+    supported.
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError):
+        return False
+    PR_SET_CHILD_SUBREAPER = 36
+    return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+
+
+class Watchdog(object):
+    """ Terminates the process group of a process after a timeout
+
+    SIGTERM is sent to the whole group first. If the process hasn't finished
+    after grace seconds SIGKILL is sent.
+    """
+
+    def __init__(self, process, timeout, grace):
+        self.process = process
+        self.timeout = timeout
+        self.grace = grace
+        self.fired = False
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def _run(self):
+        if self.done.wait(self.timeout):
+            return
+        self.fired = True
+        kill_process_group(self.process, signal.SIGTERM)
+        if not self.done.wait(self.grace):
+            kill_process_group(self.process, signal.SIGKILL)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """ Must be called after the process has finished """
+        self.done.set()
+        self.thread.join()
+
+
+def get_timeout(timeout=None, deadline=None):
+    """ Returns the remaining seconds until timeout or deadline, whichever
+    is earlier. deadline is an absolute time as returned by time.time().
+    """
+    if deadline is not None:
+        remaining = max(deadline - time.time(), 0)
+        if timeout is None or remaining < timeout:
+            timeout = remaining
+    return timeout
+
+
+class Poller(object):
+    """ Waits until file descriptors are ready for reading or writing
+
+    Uses selectors if available and falls back to poll. In contrast to select
+    both support file descriptors above FD_SETSIZE.
+    """
+
+    def __init__(self):
+        if selectors is not None:
+            self.selector = selectors.DefaultSelector()
+        else:
+            self.selector = None
+            self.poll = select.poll()
+
+    def register(self, fd, write=False):
+        if self.selector is not None:
+            self.selector.register(fd, selectors.EVENT_WRITE if write else
+                                   selectors.EVENT_READ)
+        else:
+            self.poll.register(fd, select.POLLOUT if write else select.POLLIN)
+
+    def unregister(self, fd):
+        if self.selector is not None:
+            self.selector.unregister(fd)
+        else:
+            self.poll.unregister(fd)
+
+    def wait(self):
+        """ Blocks until at least one file descriptor is ready. Returns a list
+        of the ready file descriptors.
+        """
+        if self.selector is not None:
+            return [key.fd for key, events in self.selector.select()]
+        try:
+            # a hang up or error is reported as ready to let the following
+            # read or write find out what has happened
+            return [fd for fd, events in self.poll.poll()]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+    def close(self):
+        if self.selector is not None:
+            self.selector.close()
+
+
+def _read_chunks(f):
+    while True:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def prepare_input(inputdata, kw):
+    """ Sets stdin in the Popen arguments kw for inputdata
+
+    inputdata may be a string, an iterable of strings, a file like object or a
+    kommons.path.File. Files with a file descriptor are passed directly as
+    stdin to the child process. Returns an iterator over the chunks to write
+    to stdin or None and a file to close after the process has been started or
+    None.
+    """
+    if inputdata is None:
+        return None, None
+    if isinstance(inputdata, File):
+        f = open(inputdata.get_name(), "rb")
+        kw["stdin"] = f
+        return None, f
+    if hasattr(inputdata, "fileno"):
+        try:
+            inputdata.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            # e.g. io.BytesIO
+            pass
+        else:
+            kw["stdin"] = inputdata
+            return None, None
+
+    kw["stdin"] = subprocess.PIPE
+    if isinstance(inputdata, (bytes, type(u""))):
+        return iter([inputdata]), None
+    if hasattr(inputdata, "read"):
+        return _read_chunks(inputdata), None
+    return iter(inputdata), None
+
+
 class Process(object):
 
-    def __init__(self, cmd):
+    tail_size = 4096
+
+    # seconds to wait after SIGTERM until SIGKILL is sent on a timeout
+    kill_grace = 5.0
+
+    # emitted with a ProcessResult for each process finished by run
+    finished = Signal()
+
+    # a spawner starting the subprocesses e.g. a kommons.spawn.PosixSpawner.
+    # subprocess.Popen is used if not set.
+    spawner = None
+
+    def __init__(self, cmd, spawner=None):
         self.cmd = cmd
+        if spawner is not None:
+            self.spawner = spawner
+
+    def __or__(self, other):
+        return Pipeline([self]) | other
+
+    def _start(self, extra_env=None, **kw):
+        if extra_env:
+            env = kw.get("env", os.environ).copy()
+            env.update(extra_env)
+            kw["env"] = env
+        try:
+            if self.spawner is not None:
+                return self.spawner.spawn(self.cmd, **kw)
+            return subprocess.Popen(self.cmd, **kw)
+        except OSError as e:
+            raise SubprocessError(self.cmd, e.errno, e.strerror)
+
+    def _communicate(self, process, chunks, tail):
+        """ Feeds chunks to stdin and reads stdout and stderr of process at
+        the same time. Yields (name, data) tuples of the read output.
+        """
+        poller = Poller()
+        readers = {}
+        for name in ("stdout", "stderr"):
+            f = getattr(process, name)
+            if f:
+                readers[f.fileno()] = name
+                poller.register(f.fileno())
+        writer = None
+        if process.stdin:
+            if chunks is not None:
+                writer = process.stdin.fileno()
+                poller.register(writer, write=True)
+                # only one chunk is buffered at a time
+                chunk = b""
+                offset = 0
+            else:
+                process.stdin.close()
+
+        try:
+            while readers or writer is not None:
+                for fd in poller.wait():
+                    if fd == writer:
+                        while offset >= len(chunk):
+                            chunk = next(chunks, None)
+                            offset = 0
+                            if chunk is None:
+                                break
+                            if not isinstance(chunk, bytes):
+                                chunk = chunk.encode("utf-8")
+                        try:
+                            if chunk is not None:
+                                # only PIPE_BUF bytes are guaranteed to be
+                                # writable without blocking
+                                offset += os.write(
+                                    writer, chunk[offset:offset + PIPE_BUF])
+                        except OSError as e:
+                            if e.errno != errno.EPIPE:
+                                raise
+                            # child doesn't want to read more input
+                            chunk = None
+                        if chunk is None:
+                            poller.unregister(writer)
+                            process.stdin.close()
+                            writer = None
+                        continue
+
+                    data = os.read(fd, READ_SIZE)
+                    if not data:
+                        poller.unregister(fd)
+                        getattr(process, readers.pop(fd)).close()
+                        continue
+                    tail.append(data)
+                    yield readers[fd], data
+        finally:
+            poller.close()
+
+    def _wait(self, process):
+        """ Waits until process has finished and returns its return code and
+        resource usage
+        """
+        if hasattr(process, "wait4"):
+            return process.wait4()
+        if process.returncode is not None or not hasattr(os, "wait4"):
+            return process.wait(), None
+        while True:
+            try:
+                pid, status, rusage = os.wait4(process.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        return process.returncode, rusage
+
+    def _kill(self, process):
+        for f in (process.stdin, process.stdout, process.stderr):
+            if f:
+                f.close()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    def stream(self, inputdata=None, extra_env=None, lines=False,
+               tail_size=None, timeout=None, deadline=None, **kw):
+        """Run command as a subprocess and iterate over its output.
 
-    def run(self, suppress_output=False, inputdata=None, extra_env=None, **kw):
+        Yields (name, data) tuples where name is either "stdout" or "stderr".
+        If lines is True data is split into lines, otherwise data contains
+        the chunks as read from the pipes. inputdata is written to stdin while
+        the output is read. Therefore no deadlocks can occur for large input
+        or output. If the command exits with a return code other than 0, a
+        SubprocessError is raised containing the last tail_size bytes of the
+        output. See prepare_input for the supported types of inputdata.
+        timeout and deadline are handled like in run.
+        """
+        chunks, opened = prepare_input(inputdata, kw)
+        timeout = get_timeout(timeout, deadline)
+        if timeout is not None:
+            new_process_group(kw)
+        kw.setdefault("stdout", subprocess.PIPE)
+        kw.setdefault("stderr", subprocess.PIPE)
+        if tail_size is None:
+            tail_size = self.tail_size
+        tail = OutputTail(tail_size)
+
+        try:
+            process = self._start(extra_env, **kw)
+        finally:
+            if opened:
+                opened.close()
+        watchdog = None
+        if timeout is not None:
+            watchdog = Watchdog(process, timeout, self.kill_grace)
+            watchdog.start()
+        finished = False
+        try:
+            chunks = self._communicate(process, chunks, tail)
+            if lines:
+                chunks = split_lines(chunks)
+            for name, data in chunks:
+                yield name, data
+            finished = True
+        finally:
+            if not finished:
+                # the caller stopped iterating or an error occurred
+                self._kill(process)
+            ret = process.wait()
+            if watchdog:
+                watchdog.stop()
+        if watchdog and watchdog.fired:
+            kill_process_group(process)
+            reap_process_group(process)
+            raise ProcessTimeoutError(self.cmd, ret, timeout, tail.get())
+        if ret != 0:
+            raise SubprocessError(self.cmd, ret, tail.get())
+
+    def run(self, suppress_output=False, inputdata=None, extra_env=None,
+            capture_output=False, timeout=None, deadline=None,
+            kill_group=False, **kw):
         """Run command as a subprocess and wait until it is finished.
 
         The command should be given as a list of strings to avoid problems
         with shell quoting.  If the command exits with a return code other
-        than 0, a SubprocessError is raised.
+        than 0, a SubprocessError is raised. If capture_output is True stdout
+        and stderr are not passed through and the last bytes of the output
+        are attached to the SubprocessError.
+
+        If timeout or deadline are set the command is started in a new process
+        group. If the command is still running after timeout seconds or at
+        deadline (as returned by time.time()), SIGTERM and after kill_grace
+        seconds SIGKILL are sent to the whole group and a ProcessTimeoutError
+        is raised. Remaining processes of the group are killed and reaped
+        afterwards (see set_child_subreaper). If kill_group is True the
+        command is always started in a new process group and remaining
+        processes of the group are killed after the command has finished.
+
+        inputdata may be a string, an iterable of strings, a file like object
+        or a kommons.path.File. It's streamed to stdin while the output is
+        read. Files are passed directly as stdin to the process.
+
+        Returns a ProcessResult containing the run time and resource usage of
+        the process. If capture_output is True it contains the number of bytes
+        written to stdout and stderr.
         """
-        if inputdata is not None:
-            kw["stdin"] = subprocess.PIPE
+        chunks, opened = prepare_input(inputdata, kw)
+        timeout = get_timeout(timeout, deadline)
+        if timeout is not None or kill_group:
+            new_process_group(kw)
+        if capture_output:
+            kw["stdout"] = subprocess.PIPE
+            kw["stderr"] = subprocess.PIPE
         if suppress_output:
             kw["stdout"] = open(os.devnull, "w")
             kw["stderr"] = open(os.devnull, "w")
-        if extra_env:
-            env = kw.get("env", os.environ).copy()
-            env.update(extra_env)
-            kw["env"] = env
+        start = clock()
         try:
-            process = subprocess.Popen(self.cmd, **kw)
-        except OSError, e:
-            raise SubprocessError(self.cmd, e.errno, e.strerror)
+            process = self._start(extra_env, **kw)
+        finally:
+            if opened:
+                opened.close()
+
+        watchdog = None
+        if timeout is not None:
+            watchdog = Watchdog(process, timeout, self.kill_grace)
+            watchdog.start()
+        try:
+            tail = OutputTail(self.tail_size if capture_output else 0)
+            counts = {"stdout": 0, "stderr": 0}
+            finished = False
+            try:
+                for name, data in self._communicate(process, chunks, tail):
+                    counts[name] += len(data)
+                finished = True
+            finally:
+                if not finished:
+                    # e.g. reading the input has failed
+                    self._kill(process)
+            ret, rusage = self._wait(process)
+        finally:
+            if watchdog:
+                watchdog.stop()
+        timedout = watchdog and watchdog.fired
+        if timedout or kill_group:
+            # kill the remaining processes of the group e.g. grandchildren
+            kill_process_group(process)
+            reap_process_group(process)
+
+        if capture_output and not suppress_output:
+            result = ProcessResult(self, ret, clock() - start, rusage,
+                                   counts["stdout"], counts["stderr"])
+        else:
+            result = ProcessResult(self, ret, clock() - start, rusage)
+        self.finished(result)
 
-        if inputdata is not None:
-            process.stdin.write(inputdata)
-            process.stdin.close()
-        ret = process.wait()
+        if timedout:
+            raise ProcessTimeoutError(self.cmd, ret, timeout,
+                                      tail.get() or None)
         if ret != 0:
-            raise SubprocessError(self.cmd, ret)
+            raise SubprocessError(self.cmd, ret, tail.get() or None)
+        return result
+
+    def _batches(self, args, batch, limit):
+        base = sum(_arg_size(arg) for arg in self.cmd)
+        current = []
+        size = base
+        for arg in args:
+            arg_size = _arg_size(arg)
+            if current and (size + arg_size > limit or
+                            (batch and len(current) >= batch)):
+                yield current
+                current = []
+                size = base
+            current.append(arg)
+            size += arg_size
+        if current:
+            yield current
+
+    def map(self, args, batch=None, processes=1, attribute_failures=False,
+            extra_env=None, **kw):
+        """Run the command for a large list of arguments like xargs.
+
+        The arguments are appended to the command and packed into as few
+        invocations as possible. The size of each invocation respects
+        ARG_MAX including the size of the environment. If batch is set an
+        invocation gets at most batch arguments. processes invocations are
+        run in parallel using a ProcessPool. All other keyword arguments are
+        passed to Process.run.
+
+        Returns a list of ProcessResults. If invocations have failed a
+        ProcessPoolError is raised. Each of its errors has an arguments
+        attribute containing the arguments of the failed invocation. If
+        attribute_failures is True the arguments of a failed invocation are
+        run again one by one to find the failing arguments. This must only
+        be used for idempotent commands.
+
+        The command must be a list of arguments. A timeout applies to each
+        invocation.
+        """
+        if isinstance(self.cmd, (bytes, type(u""))):
+            raise TypeError("map requires the command as a list of arguments "
+                            "not %r" % self.cmd)
+        env = dict(kw.get("env", os.environ))
+        env.update(extra_env or {})
+        env_size = sum(_arg_size("%s=%s" % item) for item in env.items())
+        limit = get_arg_max() - env_size - ARG_HEADROOM
+
+        pool = ProcessPool(processes)
+        invocations = (Process(list(self.cmd) + batch_args, self.spawner) for
+                       batch_args in self._batches(args, batch, limit))
+        try:
+            return pool.run(invocations, extra_env=extra_env, **kw)
+        except ProcessPoolError as e:
+            errors = e.errors
+            results = e.results
+
+        failed = []
+        for error in errors:
+            error.arguments = error.command[len(self.cmd):]
+            if not attribute_failures:
+                failed.append(error)
+                continue
+            singles = [Process(list(self.cmd) + [arg], self.spawner) for arg in
+                       error.arguments]
+            try:
+                results.extend(pool.run(singles, extra_env=extra_env, **kw))
+            except ProcessPoolError as single:
+                for single_error in single.errors:
+                    single_error.arguments = \
+                        single_error.command[len(self.cmd):]
+                    failed.append(single_error)
+                results.extend(single.results)
+        if failed:
+            error = ProcessPoolError(failed)
+            error.results = results
+            raise error
+        return results
+
+    def astream(self, inputdata=None, extra_env=None, lines=False,
+                tail_size=None, **kw):
+        """Asynchronous version of stream.
+
+        Returns an asynchronous iterator over (name, data) tuples. The command
+        is started in a new process group which is killed if the iteration
+        is cancelled or closed early. Requires python >= 3.6.
+        """
+        from kommons.aioprocess import astream
+        return astream(self, inputdata, extra_env, lines, tail_size, **kw)
+
+    def arun(self, suppress_output=False, inputdata=None, extra_env=None,
+             capture_output=False, **kw):
+        """Asynchronous version of run.
+
+        Returns a coroutine which returns a ProcessResult with the run time
+        and if capture_output is True the number of bytes written to stdout
+        and stderr. It raises a SubprocessError if the command exits with a
+        return code other than 0. The command is started in a new process
+        group which is killed if the coroutine is cancelled or fails.
+        Requires python >= 3.6.
+        """
+        from kommons.aioprocess import arun
+        return arun(self, suppress_output, inputdata, extra_env,
+                    capture_output, **kw)
+
+
+def _restore_sigpipe():
+    # python ignores SIGPIPE. restore the default behaviour to allow
+    # commands to terminate if the next command has exited.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+class Pipeline(object):
+    """ A chain of processes connected via OS pipes
+
+    stdout of each process is connected to stdin of the next process. A
+    Pipeline is created by combining processes with | e.g.
+    Process(["cat", "file"]) | Process(["grep", "foo"]).
+    """
+
+    def __init__(self, processes=None):
+        self.processes = list(processes or [])
+
+    def __or__(self, other):
+        if isinstance(other, Pipeline):
+            return Pipeline(self.processes + other.processes)
+        if isinstance(other, Process):
+            return Pipeline(self.processes + [other])
+        return NotImplemented
+
+    def __len__(self):
+        return len(self.processes)
+
+    def run(self, suppress_output=False, inputdata=None, extra_env=None,
+            stdin=None, stdout=None, append=False, **kw):
+        """Run all commands of the pipeline and wait until they are finished.
+
+        stdin may be a File to read the input of the first command from and
+        stdout may be a File to write the output of the last command to.
+        inputdata is handled like in Process.run. If
+        append is True the output is appended to the File. If a command exits
+        with a return code other than 0, a PipelineError is raised containing
+        the errors of all failed commands. Commands terminated by SIGPIPE
+        because a following command has exited early are not considered as
+        failed.
+
+        Returns a list of ProcessResults of all commands.
+        """
+        opened = []
+        if isinstance(stdin, File):
+            stdin = open(stdin.get_name(), "rb")
+            opened.append(stdin)
+        if isinstance(stdout, File):
+            stdout = open(stdout.get_name(), "ab" if append else "wb")
+            opened.append(stdout)
+        stdio = {"stdin": stdin}
+        chunks, f = prepare_input(inputdata, stdio)
+        stdin = stdio["stdin"]
+        if f:
+            opened.append(f)
+        if suppress_output:
+            devnull = open(os.devnull, "wb")
+            opened.append(devnull)
+            kw["stderr"] = devnull
+            if stdout is None:
+                stdout = devnull
+        if sys.version_info[0] < 3:
+            kw.setdefault("preexec_fn", _restore_sigpipe)
+
+        start = clock()
+        processes = []
+        try:
+            for i, process in enumerate(self.processes):
+                last = i == len(self.processes) - 1
+                processes.append(process._start(
+                    extra_env, stdin=stdin,
+                    stdout=stdout if last else subprocess.PIPE, **kw))
+                if i > 0:
+                    # only the next command must hold the read end of the
+                    # pipe. otherwise it doesn't get SIGPIPE.
+                    stdin.close()
+                stdin = processes[-1].stdout
+        except Exception:
+            for process in processes:
+                self._kill(process)
+            raise
+        finally:
+            for f in opened:
+                f.close()
+
+        first = processes[0]
+        if chunks is not None:
+            try:
+                for data in chunks:
+                    if not isinstance(data, bytes):
+                        data = data.encode("utf-8")
+                    first.stdin.write(data)
+            except (IOError, OSError) as e:
+                if e.errno != errno.EPIPE:
+                    raise
+            finally:
+                try:
+                    first.stdin.close()
+                except (IOError, OSError):
+                    pass
+
+        results = []
+        for process, popen in zip(self.processes, processes):
+            ret, rusage = process._wait(popen)
+            result = ProcessResult(process, ret, clock() - start, rusage)
+            Process.finished(result)
+            results.append(result)
+
+        returncodes = [result.returncode for result in results]
+        errors = []
+        for i, (process, ret) in enumerate(zip(self.processes, returncodes)):
+            if ret == 0:
+                continue
+            if ret == -signal.SIGPIPE and i < len(processes) - 1:
+                # a following command has stopped reading e.g. head
+                continue
+            errors.append(SubprocessError(process.cmd, ret))
+        if errors:
+            raise PipelineError(errors, returncodes)
+        return results
+
+    def _kill(self, process):
+        if process.stdout:
+            process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+class ProcessPool(object):
+    """ Runs many processes concurrently using a fixed number of slots """
+
+    def __init__(self, size=4, fail_fast=False, timeout=None):
+        """ Creates a new ProcessPool instance
+
+        :param size Maximum number of concurrently running processes
+        :param fail_fast If True no new processes are started after a process
+                         has failed
+        :param timeout Timeout in seconds for each process. A timeout passed
+                       to run or imap takes precedence.
+        """
+        self.size = size
+        self.fail_fast = fail_fast
+        self.timeout = timeout
+
+    def _worker(self, tasks, results, kw):
+        kw = dict(kw)
+        kw.setdefault("timeout", self.timeout)
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, process = task
+            try:
+                result = process.run(**kw)
+                results.put((index, result, None))
+            except Exception as e:
+                results.put((index, process, e))
+
+    def imap(self, processes, ordered=True, **kw):
+        """ Runs processes and yields a ProcessResult for each process that
+        has finished successfully
+
+        If ordered is True the results are yielded in the order of
+        processes, otherwise as they complete. All additional keyword
+        arguments are passed to Process.run. If one or more processes have
+        failed a ProcessPoolError containing all errors is raised at the end.
+        """
+        tasks = queue.Queue()
+        results = queue.Queue()
+        threads = []
+        for i in range(self.size):
+            thread = threading.Thread(target=self._worker,
+                                      args=(tasks, results, kw))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        processes = iter(processes)
+        exhausted = False
+        errors = []
+        pending = {}
+        index = 0
+        next_index = 0
+        running = 0
+        try:
+            while True:
+                while not exhausted and running < self.size and \
+                        not (errors and self.fail_fast):
+                    try:
+                        process = next(processes)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    tasks.put((index, process))
+                    index += 1
+                    running += 1
+                if not running:
+                    break
+
+                i, result, error = results.get()
+                running -= 1
+                if error is not None:
+                    if not isinstance(error, SubprocessError):
+                        raise error
+                    errors.append(error)
+                    result = None
+                if not ordered:
+                    if result:
+                        yield result
+                    continue
+                pending[i] = result
+                while next_index in pending:
+                    result = pending.pop(next_index)
+                    next_index += 1
+                    if result:
+                        yield result
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise ProcessPoolError(errors)
+
+    def run(self, processes, **kw):
+        """ Runs processes and waits until all have finished
+
+        Returns the list of ProcessResults. Raises a ProcessPoolError if one or
+        more processes have failed. The results of the successful processes
+        are available as its results attribute in that case.
+        """
+        results = []
+        try:
+            for result in self.imap(processes, **kw):
+                results.append(result)
+        except ProcessPoolError as e:
+            e.results = results
+            raise
+        return results
 
 # vim: et sw=4 ts=4 tw=80:
@@ -21,39 +21,92 @@
 
 """ A signals/slots implementation """
 
+import collections
+import json
+import threading
+import time
 import weakref
 
+try:
+    from concurrent import futures
+except ImportError:
+    # python 2 without the futures backport
+    futures = None
+
+from kommons.errors import KommonRuntimeError
+
+
+def get_slot_key(slot):
+    """ Returns the key of a slot. Bound methods are identified by the id of
+    their object and their function. Functions are identified by their id.
+    """
+    if hasattr(slot, "__self__"):
+        return (id(slot.__self__), slot.__func__)
+    elif hasattr(slot, "im_self"):
+        return (id(slot.im_self), slot.im_func)
+    else:
+        return (None, id(slot))
+
 
 class MethodRef(object):
 
-    def __init__(self, func):
+    def __init__(self, func, callback=None):
+        """ Creates a weak reference to a function or bound method
+
+        callback is called with the weakref if the function or the object of
+        the method is destroyed.
+        """
+        self.key = get_slot_key(func)
         if hasattr(func, "im_self"):
             # it's a method
             self.func = func.im_func
-            self.obj = weakref.ref(func.im_self)
+            self.obj = weakref.ref(func.im_self, callback)
         elif hasattr(func, "__self__"):
             # it's a python >= 2.6 method
             self.func = func.__func__
-            self.obj = weakref.ref(func.__self__)
+            self.obj = weakref.ref(func.__self__, callback)
         else:
             # it should be a function
-            self.func = weakref.ref(func)
+            self.func = weakref.ref(func, callback)
             self.obj = None
 
     def __call__(self, *args, **kwargs):
-        if self.obj:
-            if not self.obj() is None:
-                self.func(self.obj(), *args, **kwargs)
-            else:
-                return
+        if self.obj is not None:
+            obj = self.obj()
+            if obj is not None:
+                return self.func(obj, *args, **kwargs)
         else:
-            self.func()(*args, **kwargs)
+            func = self.func()
+            if func is not None:
+                return func(*args, **kwargs)
+
+    def get_function(self):
+        """ Returns the referenced function or None if it's dead. For methods
+        the unbound function is returned.
+        """
+        if self.obj is not None:
+            if self.obj() is None:
+                return None
+            return self.func
+        return self.func()
 
     def dead(self):
-        if not self.obj:
-            return False
+        if self.obj is None:
+            return self.func() is None
         return self.obj() is None
 
+    def get_name(self):
+        """ Returns a name of the slot e.g. module.Class.method """
+        func = self.get_function()
+        if func is None:
+            return "<dead>"
+        name = getattr(func, "__qualname__", None)
+        if name is None:
+            name = func.__name__
+            if self.obj is not None:
+                name = "%s.%s" % (self.obj().__class__.__name__, name)
+        return "%s.%s" % (func.__module__, name)
+
     def __eq__(self, other):
         if not self.obj:
             return self.func() == other
@@ -70,37 +123,491 @@ class MethodRef(object):
                 return False
 
 
+def _remove_slot(signal, key):
+    """ Returns a weakref callback removing the slot with key from signal """
+    signal = weakref.ref(signal)
+
+    def remove(ref):
+        current = signal()
+        if current is not None:
+            current._remove(key)
+    return remove
+
+
 class Signal(object):
+    """ A signal calls all connected slots when it is emitted
+
+    Slots are weakly referenced and are removed as soon as their function or
+    object is destroyed. connect and disconnect are O(1). Emitting iterates
+    over an immutable snapshot of the slots. Therefore slots may connect and
+    disconnect slots while the signal is emitted.
+    """
+
+    # a SignalProfiler recording the calls of the slots. set it on the
+    # class to profile all signals.
+    profiler = None
+
+    # maximum number of coroutine slots awaited concurrently by emit_async
+    async_concurrency = None
+    # timeout in seconds for each slot called by emit_async
+    async_timeout = None
+    # run non coroutine slots in the default executor in emit_async
+    async_offload = False
 
     def __init__(self):
-        self.slots = []
+        self.slots = collections.OrderedDict()
+        self.snapshot = ()
 
     def __call__(self, *args, **kwargs):
-        for i, slot in enumerate(self.slots):
-            if slot.dead():
-                del self.slots[i]
-                continue
-
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self._update()
+        if self.profiler is not None:
+            self.profiler.emit(self, snapshot, args, kwargs)
+            return
+        for slot in snapshot:
             slot(*args, **kwargs)
 
+    def emit_async(self, *args, **kwargs):
+        """ Emits the signal from asyncio code
+
+        Returns a coroutine calling all slots. Coroutine function slots are
+        awaited concurrently, limited by async_concurrency and async_timeout.
+        Other slots are called on the event loop or in the default executor
+        if async_offload is True. All slots are run even if a slot raises. The
+        first exception is raised afterwards. Requires python >= 3.5.
+        """
+        from kommons.aiosignals import emit_async
+        return emit_async(self, args, kwargs)
+
+    def get_slots(self):
+        """ Returns an immutable tuple of the MethodRefs of all slots """
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self._update()
+        return snapshot
+
+    def _update(self):
+        snapshot = tuple(self.slots.values())
+        self.snapshot = snapshot
+        return snapshot
+
+    def _remove(self, key):
+        if self.slots.pop(key, None) is not None:
+            # the snapshot is recreated on the next emit
+            self.snapshot = None
+
     def connect(self, slot):
-        if not slot in self.slots:
-            self.slots.append(MethodRef(slot))
+        key = get_slot_key(slot)
+        if key in self.slots:
+            return
+        self.slots[key] = MethodRef(slot, _remove_slot(self, key))
+        self.snapshot = None
 
     def disconnect(self, slot):
-        for i, cur_slot in enumerate(self.slots):
-            if cur_slot == slot:
-                del self.slots[i]
-                return
+        self._remove(get_slot_key(slot))
 
     def __len__(self):
-        self.clean()
         return len(self.slots)
 
     def clean(self):
-        for i, slot in enumerate(self.slots):
+        """ Removes dead slots. Dead slots are removed automatically when
+        their function or object is destroyed.
+        """
+        for key, slot in list(self.slots.items()):
             if slot.dead():
-                del self.slots[i]
+                self._remove(key)
+
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+class SlotStats(object):
+    """ Call statistics of a slot """
+
+    def __init__(self, name, samples):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        # only the latest samples are kept for the percentiles
+        self.samples = collections.deque(maxlen=samples)
+
+    def add(self, duration, error=False):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.samples.append(duration)
+
+    def get_percentile(self, percent):
+        """ Returns the percentile of the latencies of the latest calls """
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def to_dict(self):
+        return {"name": self.name, "count": self.count,
+                "errors": self.errors, "total": self.total, "max": self.max,
+                "p50": self.get_percentile(50),
+                "p90": self.get_percentile(90),
+                "p99": self.get_percentile(99)}
+
+
+class SignalProfiler(object):
+    """ Records call counts, latencies and exceptions of slots
+
+    Set it as profiler of a Signal or of the Signal class to profile
+    synchronous emissions. If an emission takes longer than budget seconds
+    on_slow is called with the signal, the duration of the emission and a
+    list of (slot name, duration) tuples of the called slots.
+    """
+
+    def __init__(self, budget=None, on_slow=None, samples=1000):
+        self.budget = budget
+        self.on_slow = on_slow
+        self.samples = samples
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _add(self, name, duration, error):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = SlotStats(name, self.samples)
+                self.stats[name] = stats
+            stats.add(duration, error)
+
+    def emit(self, signal, slots, args, kwargs):
+        durations = []
+        start = clock()
+        for slot in slots:
+            name = slot.get_name()
+            slot_start = clock()
+            error = True
+            try:
+                slot(*args, **kwargs)
+                error = False
+            finally:
+                duration = clock() - slot_start
+                self._add(name, duration, error)
+                durations.append((name, duration))
+        duration = clock() - start
+        if self.budget is not None and duration > self.budget and \
+                self.on_slow is not None:
+            self.on_slow(signal, duration, durations)
+
+    def snapshot(self):
+        """ Returns a list of dicts with the statistics of all slots sorted
+        by their total time
+        """
+        with self.lock:
+            stats = [s.to_dict() for s in self.stats.values()]
+        return sorted(stats, key=lambda s: s["total"], reverse=True)
+
+    def export(self, filename=None):
+        """ Returns the snapshot as JSON string and writes it to filename if
+        set
+        """
+        data = json.dumps(self.snapshot(), indent=2)
+        if filename:
+            with open(filename, "w") as f:
+                f.write(data)
+        return data
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def get_default_executor():
+    """ Returns the executor shared by all ThreadSignals without an own
+    executor
+    """
+    global _default_executor
+    if _default_executor is None:
+        if futures is None:
+            raise KommonRuntimeError("concurrent.futures is required for "
+                                     "the default executor")
+        with _default_executor_lock:
+            if _default_executor is None:
+                _default_executor = futures.ThreadPoolExecutor(4)
+    return _default_executor
+
+
+class Emission(object):
+    """ Completion handle of a ThreadSignal emission """
+
+    def __init__(self, futures):
+        self.futures = futures
+
+    def done(self):
+        """ Returns True if all slots have been called """
+        return all(future.done() for future in self.futures)
+
+    def wait(self, timeout=None):
+        """ Waits until all slots have been called. Returns False if timeout
+        seconds have passed before.
+        """
+        done, not_done = futures.wait(self.futures, timeout)
+        return not not_done
+
+    def exceptions(self):
+        """ Waits until all slots have been called and returns the raised
+        exceptions
+        """
+        return [e for e in (future.exception() for future in self.futures)
+                if e is not None]
+
+    def result(self, timeout=None):
+        """ Waits until all slots have been called and raises the first
+        exception raised by a slot
+        """
+        for future in self.futures:
+            future.result(timeout)
+
+
+class ThreadSignal(Signal):
+    """ A thread-safe Signal which can call its slots on an executor
+
+    The slots are stored copy-on-write. connect and disconnect replace them
+    while holding a lock. Emitters only read the current snapshot and never
+    lock.
+    """
+
+    def __init__(self, executor=None):
+        super(ThreadSignal, self).__init__()
+        self.executor = executor
+        self.lock = threading.Lock()
+        # keys of destroyed slots. the weakref callbacks may run in a thread
+        # holding the lock e.g. if the garbage collection runs during connect.
+        # therefore they only queue the keys like WeakSet does and the keys
+        # are removed by the next thread holding the lock.
+        self.pending = []
+
+    def _replace(self, slots):
+        while self.pending:
+            slots.pop(self.pending.pop(), None)
+        self.slots = slots
+        self.snapshot = tuple(slots.values())
+
+    def _remove(self, key):
+        self.pending.append(key)
+        if self.lock.acquire(False):
+            try:
+                self._replace(self.slots.copy())
+            finally:
+                self.lock.release()
+
+    def connect(self, slot):
+        key = get_slot_key(slot)
+        with self.lock:
+            if key in self.slots and not self.pending:
+                return
+            slots = self.slots.copy()
+            # drop destroyed slots first. their keys may be reused.
+            while self.pending:
+                slots.pop(self.pending.pop(), None)
+            if key not in slots:
+                slots[key] = MethodRef(slot, _remove_slot(self, key))
+            self._replace(slots)
+
+    def disconnect(self, slot):
+        key = get_slot_key(slot)
+        with self.lock:
+            if key not in self.slots and not self.pending:
+                return
+            slots = self.slots.copy()
+            slots.pop(key, None)
+            self._replace(slots)
+
+    def emit(self, *args, **kwargs):
+        """ Calls all slots on the executor and returns an Emission """
+        executor = self.executor or get_default_executor()
+        return Emission([executor.submit(slot, *args, **kwargs) for slot in
+                         self.snapshot])
+
+
+class CoalescingSignal(Signal):
+    """ A Signal which buffers emissions and delivers them as one batch
+
+    Slots are called with a list of (args, kwargs) tuples of the buffered
+    emissions. The batch is delivered if max_count emissions are buffered or
+    the oldest buffered emission is older than max_latency seconds. If key is
+    set it's called with the arguments of each emission and only the latest
+    emission per key is kept.
+
+    Without background the latency is only checked on emissions. flush must
+    be called to deliver the remaining emissions. With background a timer
+    thread delivers the batch after max_latency seconds.
+    """
+
+    def __init__(self, max_count=None, max_latency=None, key=None,
+                 background=False):
+        super(CoalescingSignal, self).__init__()
+        self.max_count = max_count
+        self.max_latency = max_latency
+        self.key = key
+        self.background = background
+        self.lock = threading.Lock()
+        self.timer = None
+        self._reset()
+
+    def _reset(self):
+        if self.key is None:
+            self.pending = []
+        else:
+            self.pending = collections.OrderedDict()
+        self.first = None
+
+    def __call__(self, *args, **kwargs):
+        emission = (args, kwargs)
+        with self.lock:
+            if self.key is None:
+                self.pending.append(emission)
+            else:
+                self.pending[self.key(*args, **kwargs)] = emission
+            now = time.time()
+            if self.first is None:
+                self.first = now
+                if self.background and self.max_latency is not None:
+                    self.timer = threading.Timer(self.max_latency,
+                                                 self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+            flush = (self.max_count is not None and
+                     len(self.pending) >= self.max_count) or \
+                (self.max_latency is not None and
+                 now - self.first >= self.max_latency)
+        if flush:
+            self.flush()
+
+    def get_pending(self):
+        """ Returns the number of buffered emissions """
+        return len(self.pending)
+
+    def flush(self):
+        """ Delivers all buffered emissions to the slots """
+        with self.lock:
+            if not self.pending:
+                return
+            if self.key is None:
+                batch = self.pending
+            else:
+                batch = list(self.pending.values())
+            self._reset()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        super(CoalescingSignal, self).__call__(batch)
+
+    def close(self):
+        """ Delivers the buffered emissions and stops the timer """
+        self.flush()
+
+
+class TopicNode(object):
+
+    def __init__(self):
+        self.children = {}
+        self.signal = None
+
+    def is_empty(self):
+        return not self.children and not (self.signal and len(self.signal))
+
+
+class SignalHub(object):
+    """ Routes emissions to subscribers by hierarchical topics
+
+    Topics are strings with segments separated by dots e.g. build.foo.finished.
+    Subscription patterns may contain * to match exactly one segment e.g.
+    build.*.finished. The patterns are stored in a trie. Therefore the costs
+    of routing depend on the depth of the topic and not on the number of
+    subscribers. Subscribers are weakly referenced like the slots of a Signal
+    and are called with the topic and the emitted arguments.
+    """
+
+    separator = "."
+    wildcard = "*"
+
+    def __init__(self):
+        self.root = TopicNode()
+
+    def _split(self, topic):
+        return topic.split(self.separator)
+
+    def get_signal(self, pattern):
+        """ Returns the Signal of the subscribers of pattern """
+        node = self.root
+        for segment in self._split(pattern):
+            child = node.children.get(segment)
+            if child is None:
+                child = TopicNode()
+                node.children[segment] = child
+            node = child
+        if node.signal is None:
+            node.signal = Signal()
+        return node.signal
+
+    def subscribe(self, pattern, slot):
+        self.get_signal(pattern).connect(slot)
+
+    def unsubscribe(self, pattern, slot):
+        nodes = [self.root]
+        for segment in self._split(pattern):
+            node = nodes[-1].children.get(segment)
+            if node is None:
+                return
+            nodes.append(node)
+        if nodes[-1].signal is not None:
+            nodes[-1].signal.disconnect(slot)
+        # remove nodes without subscribers and children
+        segments = self._split(pattern)
+        for segment, parent, node in reversed(list(zip(segments, nodes,
+                                                       nodes[1:]))):
+            if not node.is_empty():
+                break
+            del parent.children[segment]
+
+    def match(self, topic):
+        """ Returns the Signals of all patterns matching topic """
+        nodes = [self.root]
+        for segment in self._split(topic):
+            matched = []
+            for node in nodes:
+                child = node.children.get(segment)
+                if child is not None:
+                    matched.append(child)
+                child = node.children.get(self.wildcard)
+                if child is not None:
+                    matched.append(child)
+            if not matched:
+                return []
+            nodes = matched
+        return [node.signal for node in nodes if node.signal is not None]
+
+    def emit(self, topic, *args, **kwargs):
+        """ Calls all subscribers of patterns matching topic """
+        for signal in self.match(topic):
+            signal(topic, *args, **kwargs)
+
+    def clean(self):
+        """ Removes all nodes without subscribers """
+        def clean(node):
+            for segment, child in list(node.children.items()):
+                clean(child)
+                if child.is_empty():
+                    del node.children[segment]
+        clean(self.root)
 
 
 class ForwardSignal(object):
@@ -114,6 +621,14 @@ class ForwardSignal(object):
     def disconnect(self, slot):
         self.signal.disconnect(slot)
 
+    def flush(self):
+        """ Delivers the buffered emissions if the signal is a
+        CoalescingSignal
+        """
+        flush = getattr(self.signal, "flush", None)
+        if flush is not None:
+            flush()
+
     def __len__(self):
         return len(self.signal)
 
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+""" Strategies to spawn processes with a low latency
+
+subprocess.Popen forks the calling process. The cost of fork grows with the
+memory of the caller. The spawners in this module start processes without
+forking the caller. They can be used with kommons.process.Process e.g.
+Process(["ls"], spawner=PosixSpawner()).
+"""
+
+import array
+import errno
+import os
+import pickle
+import resource
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+from kommons.errors import KommonRuntimeError
+
+HEADER = struct.Struct("!I")
+MAX_FDS = 4
+
+
+class SpawnError(KommonRuntimeError):
+    pass
+
+
+def _status_to_returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class _Stdio(object):
+    """ Creates the file descriptors for stdin, stdout and stderr of a child
+    process from the Popen like arguments
+    """
+
+    def __init__(self, stdin=None, stdout=None, stderr=None):
+        self.fds = []
+        self.files = []
+        self.child_fds = []
+        for i, spec in enumerate((stdin, stdout, stderr)):
+            parent = None
+            if spec is None:
+                child = i
+            elif spec == subprocess.PIPE:
+                r, w = os.pipe()
+                if i == 0:
+                    child, parent = r, os.fdopen(w, "wb")
+                else:
+                    child, parent = w, os.fdopen(r, "rb")
+                self.child_fds.append(child)
+            elif spec == getattr(subprocess, "DEVNULL", None):
+                child = os.open(os.devnull, os.O_RDWR)
+                self.child_fds.append(child)
+            elif spec == subprocess.STDOUT and i == 2:
+                child = self.fds[1]
+            elif isinstance(spec, int):
+                child = spec
+            else:
+                child = spec.fileno()
+            self.fds.append(child)
+            self.files.append(parent)
+
+    def close_child_fds(self):
+        for fd in self.child_fds:
+            os.close(fd)
+        self.child_fds = []
+
+    def close(self):
+        self.close_child_fds()
+        for f in self.files:
+            if f:
+                f.close()
+
+
+class SpawnedProcess(object):
+    """ A subprocess.Popen like object for processes started by a spawner """
+
+    def __init__(self, pid, stdin=None, stdout=None, stderr=None):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.returncode = _status_to_returncode(status)
+        return self.returncode
+
+    def wait4(self):
+        """ Waits until the process has finished and returns its return code
+        and resource usage
+        """
+        if self.returncode is not None:
+            return self.returncode, None
+        while True:
+            try:
+                pid, status, rusage = os.wait4(self.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        self.returncode = _status_to_returncode(status)
+        return self.returncode, rusage
+
+    def wait(self):
+        if self.returncode is None:
+            self.wait4()
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class PopenSpawner(object):
+    """ Spawns processes using subprocess.Popen. This is the default. """
+
+    def spawn(self, cmd, **kw):
+        return subprocess.Popen(cmd, **kw)
+
+
+class PosixSpawner(PopenSpawner):
+    """ Spawns processes using os.posix_spawnp
+
+    posix_spawn uses vfork semantics and therefore doesn't copy the page
+    tables of the caller. Popen is used as fallback if posix_spawn is not
+    available (python < 3.8) or if arguments are passed which are not
+    supported by posix_spawn e.g. cwd or preexec_fn.
+    """
+
+    supported = set(["stdin", "stdout", "stderr", "env", "close_fds",
+                     "start_new_session"])
+
+    def can_spawn(self, cmd, **kw):
+        return hasattr(os, "posix_spawnp") and \
+            isinstance(cmd, (list, tuple)) and \
+            set(kw).issubset(self.supported) and kw.get("close_fds", True)
+
+    def spawn(self, cmd, **kw):
+        if not self.can_spawn(cmd, **kw):
+            return super(PosixSpawner, self).spawn(cmd, **kw)
+
+        stdio = _Stdio(kw.get("stdin"), kw.get("stdout"), kw.get("stderr"))
+        file_actions = [(os.POSIX_SPAWN_DUP2, fd, i) for i, fd in
+                        enumerate(stdio.fds) if fd != i]
+        env = kw.get("env")
+        if env is None:
+            env = os.environ
+        try:
+            pid = os.posix_spawnp(cmd[0], cmd, env, file_actions=file_actions,
+                                  setsid=kw.get("start_new_session", False))
+        except Exception:
+            stdio.close()
+            raise
+        stdio.close_child_fds()
+        return SpawnedProcess(pid, *stdio.files)
+
+
+def _send(sock, obj, fds=()):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    data = HEADER.pack(len(data)) + data
+    if fds:
+        sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                               array.array("i", fds))])
+    else:
+        sock.sendall(data)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv(sock):
+    """ Receives an object and the file descriptors sent with it """
+    fds = array.array("i")
+    data, ancdata, flags, addr = sock.recvmsg(
+        HEADER.size, socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+    if not data:
+        raise EOFError()
+    for level, type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) -
+                                    (len(cmsg_data) % fds.itemsize)])
+    if len(data) < HEADER.size:
+        data += _recv_exact(sock, HEADER.size - len(data))
+    size, = HEADER.unpack(data)
+    return pickle.loads(_recv_exact(sock, size)), list(fds)
+
+
+def _handle(channel):
+    with channel:
+        request, fds = _recv(channel)
+        try:
+            process = subprocess.Popen(request["cmd"], stdin=fds[0],
+                                       stdout=fds[1], stderr=fds[2],
+                                       env=request["env"],
+                                       cwd=request["cwd"],
+                                       start_new_session=request["setsid"])
+        except OSError as e:
+            _send(channel, ("error", e.errno, e.strerror))
+            return
+        finally:
+            for fd in fds:
+                os.close(fd)
+        _send(channel, ("pid", process.pid))
+        while True:
+            try:
+                pid, status, rusage = os.wait4(process.pid, 0)
+                break
+            except InterruptedError:
+                pass
+        process.returncode = _status_to_returncode(status)
+        try:
+            _send(channel, ("exit", status, tuple(rusage)))
+        except OSError:
+            # client is gone
+            pass
+
+
+def serve(fd):
+    """ Main loop of the spawn server process
+
+    Each request is a new socket sent over the control socket fd. A spawn
+    request is read from the new socket and the pid and later the exit status
+    of the spawned process are sent back.
+    """
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=fd)
+    while True:
+        try:
+            obj, fds = _recv(control)
+        except EOFError:
+            # client has closed the connection
+            break
+        channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM,
+                                fileno=fds[0])
+        thread = threading.Thread(target=_handle, args=(channel,))
+        thread.daemon = True
+        thread.start()
+
+
+class ServerProcess(SpawnedProcess):
+    """ A process started by a SpawnServer """
+
+    def __init__(self, channel, pid, stdin=None, stdout=None, stderr=None):
+        super(ServerProcess, self).__init__(pid, stdin, stdout, stderr)
+        self.channel = channel
+        self.rusage = None
+
+    def _read_exit(self):
+        try:
+            msg, fds = _recv(self.channel)
+        except EOFError:
+            raise SpawnError("Spawn server has closed the connection")
+        name, status, rusage = msg
+        self.returncode = _status_to_returncode(status)
+        self.rusage = resource.struct_rusage(rusage)
+        self.channel.close()
+
+    def poll(self):
+        if self.returncode is None:
+            rlist, wlist, xlist = select.select([self.channel], [], [], 0)
+            if rlist:
+                self._read_exit()
+        return self.returncode
+
+    def wait4(self):
+        if self.returncode is None:
+            self._read_exit()
+        return self.returncode, self.rusage
+
+
+class SpawnServer(object):
+    """ A long-lived small helper process which spawns processes on request
+
+    The helper is started as a fresh python interpreter. Therefore the costs
+    of spawning a process don't depend on the memory of the caller. The
+    server should be started early. It can be used as a context manager and
+    is stopped automatically in that case. Requires python >= 3.3.
+    """
+
+    supported = set(["stdin", "stdout", "stderr", "env", "cwd", "close_fds",
+                     "start_new_session"])
+
+    def __init__(self):
+        self.process = None
+        self.control = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        control, remote = socket.socketpair(socket.AF_UNIX,
+                                            socket.SOCK_STREAM)
+        env = os.environ.copy()
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(
+            [path] + [p for p in [env.get("PYTHONPATH")] if p])
+        with remote:
+            self.process = subprocess.Popen(
+                [sys.executable, "-c",
+                 "import sys; from kommons.spawn import serve; "
+                 "serve(int(sys.argv[1]))", str(remote.fileno())],
+                pass_fds=[remote.fileno()], env=env)
+        self.control = control
+
+    def stop(self):
+        if self.control:
+            self.control.close()
+            self.control = None
+            self.process.wait()
+
+    def is_running(self):
+        return self.control is not None
+
+    def spawn(self, cmd, **kw):
+        if not self.is_running():
+            raise SpawnError("Spawn server is not running")
+        if not isinstance(cmd, (list, tuple)):
+            raise SpawnError("Spawn server requires a list as command")
+        unsupported = set(kw) - self.supported
+        if unsupported:
+            raise SpawnError("Spawn server doesn't support %s" %
+                             ", ".join(sorted(unsupported)))
+
+        env = kw.get("env")
+        if env is None:
+            env = os.environ
+        request = {"cmd": list(cmd), "env": dict(env), "cwd": kw.get("cwd"),
+                   "setsid": kw.get("start_new_session", False)}
+        stdio = _Stdio(kw.get("stdin"), kw.get("stdout"), kw.get("stderr"))
+        channel, remote = socket.socketpair(socket.AF_UNIX,
+                                            socket.SOCK_STREAM)
+        try:
+            with remote:
+                with self.lock:
+                    _send(self.control, None, [remote.fileno()])
+            _send(channel, request, stdio.fds)
+            stdio.close_child_fds()
+            reply, fds = _recv(channel)
+        except Exception:
+            channel.close()
+            stdio.close()
+            raise
+        if reply[0] == "error":
+            channel.close()
+            stdio.close()
+            raise OSError(reply[1], reply[2])
+        return ServerProcess(channel, reply[1], *stdio.files)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+# vim: et sw=4 ts=4 tw=80:
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+""" A content-addressed store for files """
+
+import errno
+import hashlib
+import os
+import stat
+import tempfile
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from kommons.errors import KommonRuntimeError
+from kommons.path import Directory, File
+
+
+class ContentStoreError(KommonRuntimeError):
+
+    def __init__(self, digest, message):
+        self.digest = digest
+        self.message = message
+
+    def __str__(self):
+        return "Blob %s: %s" % (self.digest, self.message)
+
+
+class ContentStore(object):
+    """ Stores files by the hash of their content
+
+    Each blob is placed in a fan-out directory derived from its digest e.g.
+    objects/ab/cdef... for fanout=1. Blobs are inserted atomically and are
+    read-only. Blobs can be hard linked into other directories. The number of
+    these links is used as the reference count of a blob and referenced blobs
+    are never removed by the garbage collection.
+    """
+
+    chunk_size = 64 * 1024
+
+    # the garbage collection after inserts reduces the store to this fraction
+    # of max_size to not run again on the next insert
+    low_water = 0.9
+
+    def __init__(self, directory, fanout=1, algorithm="sha1", max_size=None):
+        """ Creates a new ContentStore instance
+
+        :param directory Root directory of the store
+        :param fanout Number of two character subdirectory levels a blob is
+                      placed in
+        :param algorithm Name of the hashlib algorithm to use for the digests
+        :param max_size If set the garbage collection is run after inserts
+                        which exceed max_size bytes to keep the store below
+                        max_size bytes
+        """
+        if not isinstance(directory, Directory):
+            directory = Directory(directory)
+        self.directory = directory
+        self.fanout = fanout
+        self.algorithm = algorithm
+        self.max_size = max_size
+        self.objects = directory + "objects"
+        self.tmp = directory + "tmp"
+        self.objects.create()
+        self.tmp.create()
+        # estimated size of the store. it's determined by the garbage
+        # collection and increased by the inserts of this instance.
+        self.estimated_size = None
+        self.size_lock = threading.Lock()
+
+    def _new_hash(self):
+        return hashlib.new(self.algorithm)
+
+    def _get_path(self, digest):
+        parts = [digest[i * 2:i * 2 + 2] for i in range(self.fanout)]
+        parts.append(digest[self.fanout * 2:])
+        return os.path.join(self.objects.get_name(), *parts)
+
+    def _touch(self, path):
+        # update only the access time. the modification time is shared with
+        # all hard links and must not change.
+        st = os.stat(path)
+        os.utime(path, (time.time(), st.st_mtime))
+
+    def hash_file(self, file):
+        """ Returns the digest of the content of file """
+        if isinstance(file, File):
+            file = file.get_name()
+        h = self._new_hash()
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _insert(self, chunks):
+        fd, tmpname = tempfile.mkstemp(dir=self.tmp.get_name())
+        try:
+            h = self._new_hash()
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    h.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            digest = h.hexdigest()
+            path = self._get_path(digest)
+            os.chmod(tmpname, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            Directory(os.path.dirname(path)).create()
+            try:
+                # link doesn't overwrite an existing blob in contrast to
+                # rename. therefore concurrent inserts of the same content
+                # are safe.
+                os.link(tmpname, path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self._touch(path)
+            else:
+                with self.size_lock:
+                    if self.estimated_size is not None:
+                        self.estimated_size += size
+        finally:
+            os.remove(tmpname)
+        return digest
+
+    def _put(self, file):
+        if isinstance(file, File):
+            file = file.get_name()
+        with open(file, "rb") as f:
+            return self._insert(iter(lambda: f.read(self.chunk_size), b""))
+
+    def _maybe_gc(self):
+        # walking all blobs is expensive. therefore the garbage collection
+        # only runs if the estimated size exceeds max_size.
+        if self.max_size is None:
+            return
+        with self.size_lock:
+            size = self.estimated_size
+        if size is None or size > self.max_size:
+            self.gc(int(self.max_size * self.low_water))
+
+    def put(self, file):
+        """ Inserts the content of file into the store and returns its
+        digest
+        """
+        digest = self._put(file)
+        self._maybe_gc()
+        return digest
+
+    def put_data(self, data):
+        """ Inserts a string into the store and returns its digest """
+        digest = self._insert([data])
+        self._maybe_gc()
+        return digest
+
+    def put_many(self, files, threads=4):
+        """ Inserts several files in parallel and returns their digests in
+        the order of files
+        """
+        pool = ThreadPool(threads)
+        try:
+            digests = pool.map(self._put, files)
+        finally:
+            pool.close()
+            pool.join()
+        self._maybe_gc()
+        return digests
+
+    def has(self, digest):
+        """ Returns True if a blob with digest is in the store """
+        return os.path.exists(self._get_path(digest))
+
+    def get(self, digest):
+        """ Returns the blob with digest as File or None if not found """
+        path = self._get_path(digest)
+        try:
+            self._touch(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return File(path)
+
+    def link(self, digest, dest):
+        """ Creates a hard link of the blob with digest at dest
+
+        Returns dest as File. The link counts as a reference to the blob until
+        it is deleted.
+        """
+        blob = self.get(digest)
+        if blob is None:
+            raise ContentStoreError(digest, "not found in store")
+        if not isinstance(dest, File):
+            dest = File(dest)
+        dest_dir = dest.get_directory()
+        if dest_dir:
+            dest_dir.create()
+        blob.link(dest)
+        return dest
+
+    def refcount(self, digest):
+        """ Returns the number of hard links to the blob outside of the
+        store
+        """
+        return os.stat(self._get_path(digest)).st_nlink - 1
+
+    def remove(self, digest):
+        """ Removes the blob with digest from the store """
+        File(self._get_path(digest)).delete_if_exists()
+
+    def _blobs(self):
+        objects = self.objects.get_name()
+        for dirpath, dirnames, filenames in os.walk(objects):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                digest = os.path.relpath(path, objects).replace(os.sep, "")
+                try:
+                    st = os.stat(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                yield digest, path, st
+
+    def size(self):
+        """ Returns the size of all blobs in the store in bytes """
+        return sum(st.st_size for digest, path, st in self._blobs())
+
+    def gc(self, max_size=None):
+        """ Removes least recently used blobs until the store is below
+        max_size bytes
+
+        Blobs that are still referenced are kept. If max_size is not set the
+        max_size of the store is used. If both are not set all unreferenced
+        blobs are removed. Returns a list of the removed digests.
+        """
+        if max_size is None:
+            max_size = self.max_size or 0
+        blobs = list(self._blobs())
+        size = sum(st.st_size for digest, path, st in blobs)
+        removed = []
+        blobs.sort(key=lambda blob: blob[2].st_atime)
+        for digest, path, st in blobs:
+            if size <= max_size:
+                break
+            if st.st_nlink > 1:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            size -= st.st_size
+            removed.append(digest)
+        with self.size_lock:
+            self.estimated_size = size
+        return removed
+
+# vim: et sw=4 ts=4 tw=80:
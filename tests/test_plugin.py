@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from kommons.plugin import (BundleLoader, FileLoader, SourceScanner,
+                            build_bundle)
+
+
+class PluginTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, source):
+        filename = os.path.join(self.directory, name)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(filename, "w") as f:
+            f.write(source)
+
+
+class FileLoaderTest(PluginTestCase):
+
+    def test_lazy_load(self):
+        self.write("lazy.py", "class A(object): pass\n")
+        loader = FileLoader([self.directory], lazy=True)
+        module = loader.load_module("lazy", "lazy_test_module")
+        self.assertFalse(module.is_loaded())
+        self.assertEqual(module.get_class("A").__name__, "A")
+        self.assertTrue(module.is_loaded())
+
+    def test_lazy_load_missing(self):
+        loader = FileLoader([self.directory], lazy=True)
+        self.assertEqual(loader.load_module("missing"), None)
+
+
+class SourceScannerTest(PluginTestCase):
+
+    def test_subclasses_reachable_through_several_bases(self):
+        self.write("plugins.py", "class A(object): pass\n"
+                                 "class B(A): pass\n"
+                                 "class C(A, B): pass\n")
+        scanner = SourceScanner(FileLoader([self.directory]))
+        names = [info.name for info in scanner.get_classes("A")]
+        self.assertEqual(names, ["B", "C"])
+
+
+class BundleLoaderTest(PluginTestCase):
+
+    def test_package_with_submodules(self):
+        self.write(os.path.join("plugins", "bundlepkg", "__init__.py"),
+                   "from . import sub\n"
+                   "from .inner import deep\n"
+                   "class P(sub.S): pass\n")
+        self.write(os.path.join("plugins", "bundlepkg", "sub.py"),
+                   "class S(object): pass\n")
+        self.write(os.path.join("plugins", "bundlepkg", "inner",
+                                "__init__.py"), "")
+        self.write(os.path.join("plugins", "bundlepkg", "inner", "deep.py"),
+                   "VALUE = 42\n")
+        filename = os.path.join(self.directory, "plugins.zip")
+        names = build_bundle(os.path.join(self.directory, "plugins"),
+                             filename)
+        self.assertEqual(names, ["bundlepkg", "bundlepkg.inner",
+                                 "bundlepkg.inner.deep", "bundlepkg.sub"])
+        loader = BundleLoader(filename)
+        try:
+            module = loader.load_module("bundlepkg")
+            self.assertEqual(module.get_class("P").__name__, "P")
+            self.assertEqual(module.module.deep.VALUE, 42)
+            self.assertEqual(loader.load_module("missing"), None)
+        finally:
+            loader.close()
+            for name in list(sys.modules):
+                if name.startswith("bundlepkg"):
+                    del sys.modules[name]
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: et sw=4 ts=4 tw=80:
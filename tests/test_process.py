@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from kommons.process import PIPE_BUF, Process
+
+
+class ProcessInputTest(unittest.TestCase):
+
+    # larger than the pipe buffer of the child
+    size = 1000000
+
+    def get_input(self):
+        return bytes(bytearray(i % 251 for i in range(self.size)))
+
+    def test_stream_roundtrip(self):
+        data = self.get_input()
+        output = b"".join(chunk for name, chunk in
+                          Process(["cat"]).stream(inputdata=data)
+                          if name == "stdout")
+        self.assertEqual(output, data)
+
+    def test_stream_roundtrip_chunks(self):
+        data = self.get_input()
+        chunks = [data[i:i + PIPE_BUF * 3]
+                  for i in range(0, len(data), PIPE_BUF * 3)]
+        output = b"".join(chunk for name, chunk in
+                          Process(["cat"]).stream(inputdata=iter(chunks))
+                          if name == "stdout")
+        self.assertEqual(output, data)
+
+    def test_run_roundtrip(self):
+        result = Process(["cat"]).run(inputdata=self.get_input(),
+                                      capture_output=True)
+        self.assertEqual(result.stdout_bytes, self.size)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: et sw=4 ts=4 tw=80:
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# kommons - A library for common classes and functions
+#
+# Copyright (C) 2013  Björn Ricks <bjoern.ricks@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA
+
+import gc
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from kommons.signals import ThreadSignal
+
+
+class Receiver(object):
+
+    def __init__(self):
+        # a reference cycle. the receiver is only freed by the gc.
+        self.cycle = self
+
+    def slot(self):
+        pass
+
+
+class ThreadSignalTest(unittest.TestCase):
+
+    def test_remove_while_locked(self):
+        signal = ThreadSignal()
+        receiver = Receiver()
+        other = Receiver()
+        signal.connect(receiver.slot)
+        del receiver
+        with signal.lock:
+            # the weakref callback runs in the thread holding the lock
+            gc.collect()
+        signal.connect(other.slot)
+        self.assertEqual(len(signal), 1)
+        self.assertEqual(signal.pending, [])
+
+    def test_disconnect(self):
+        signal = ThreadSignal()
+        receiver = Receiver()
+        signal.connect(receiver.slot)
+        signal.disconnect(receiver.slot)
+        self.assertEqual(len(signal), 0)
+        self.assertEqual(signal.get_slots(), ())
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: et sw=4 ts=4 tw=80: